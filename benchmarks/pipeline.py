@@ -0,0 +1,361 @@
+"""
+Time each stage of the pipeline on synthetic maps and replays, and write the
+results as JSON so runs can be compared between commits.
+
+    python -m benchmarks.pipeline --output before.json
+    python -m benchmarks.pipeline --output after.json --compare before.json
+
+Everything runs in a temporary directory, so no downloaded data is needed.
+Each stage is run once to compile numba functions, then timed over several
+repeats, reporting the median.
+"""
+
+import datetime
+import json
+import lzma
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+import slider
+from slider.mod import Mod
+
+from osu_ml_difficulty import beatmap, config, dataset, db, fast_replay, frame, frame_store, map_store, replay_features
+from osu_ml_difficulty.osu_file import OsuFile
+from benchmarks.synthetic import osr_bytes, osu_text, played_action_text
+
+
+MODS = [0, Mod.double_time, Mod.hard_rock, Mod.hidden | Mod.double_time, Mod.half_time, Mod.easy]
+
+# stages which were renamed, from their new name to the name in older results,
+# so --compare still matches them
+RENAMED_STAGES = {
+    "dataset.note_features": "dataset.augment_beatmap_data",
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_maps(rng, map_count, hit_object_count):
+    """
+    Write synthetic maps to config.OSU_MAP_PATH and index them in a slider
+    library. Returns their md5s
+    """
+    os.makedirs(config.OSU_MAP_PATH, exist_ok=True)
+    for i in range(map_count):
+        with open(os.path.join(config.OSU_MAP_PATH, f"map{i}.osu"), "w") as osu_file:
+            osu_file.write(osu_text(rng, i, hit_object_count))
+    slider.Library.create_db(config.OSU_MAP_PATH)
+    return sorted(beatmap.get_library().md5s)
+
+
+def create_replays(rng, md5s, user_count, replays_per_user):
+    """
+    Returns (username, mods, .osr data) for replays of random maps, clicking
+    each hit object with some timing and aim error
+    """
+    replays = []
+    timestamp = datetime.datetime(2020, 1, 1)
+    for user in range(user_count):
+        for _ in range(replays_per_user):
+            md5 = md5s[rng.integers(len(md5s))]
+            mods = int(MODS[rng.integers(len(MODS))])
+            times, positions = OsuFile.from_path(beatmap.beatmap_path(md5)).hit_objects(
+                hard_rock=bool(mods & Mod.hard_rock))
+            actions = played_action_text(rng, times / 1e3, positions)
+            timestamp += datetime.timedelta(minutes=5)
+            replays.append((f"user{user}", mods, osr_bytes(
+                rng, md5, f"user{user}", mods, timestamp=timestamp, actions=actions)))
+    return replays
+
+
+def import_replays(replays):
+    """
+    Save frames and features for parsed replays, and add them to the db, as
+    import_replay_data.py --extract-features would
+    """
+    db.init_db()
+    with db.db:
+        users = {}
+        for username, _, data in replays:
+            replay = fast_replay.FastReplay.parse(data)
+            if username not in users:
+                users[username] = db.User.create(
+                    username=username, rank=len(users), pp=0, play_time=0, play_count=0,
+                    history_completeness=100)
+
+            filename = f"{username}-{replay.beatmap_md5}-{replay.timestamp.strftime('%Y-%m-%d_%H-%M-%S.%f')}.npy"
+            np.save(os.path.join(config.REPLAY_PATH, filename), replay.actions)
+            map_data = beatmap.get_beatmap(
+                replay.beatmap_md5,
+                dt=replay.double_time, hd=replay.hidden, hr=replay.hard_rock, ez=replay.easy, ht=replay.half_time
+            )
+            features = replay_features.click_features(
+                np.copy(replay.actions), map_data, dt=replay.double_time, ht=replay.half_time)
+            replay_features.save_features(os.path.join(config.REPLAY_FEATURE_PATH, filename), features)
+            db.Replay.create(
+                user=users[username], mods=replay.difficulty_mods(), beatmap_md5=replay.beatmap_md5,
+                timestamp=replay.timestamp, filename=filename, count_300=replay.count_300,
+                count_100=replay.count_100, count_50=replay.count_50, count_miss=replay.count_miss,
+                max_combo=replay.max_combo, score=replay.score)
+
+
+def _map_key(replay):
+    return (replay.beatmap_md5, replay.double_time, replay.hidden, replay.hard_rock, replay.easy, replay.half_time)
+
+
+def clear_map_caches(pickles=False):
+    beatmap.get_beatmap.cache_clear()
+    beatmap.read_osu_file.cache_clear()
+    map_store.get_store.cache_clear()
+    if pickles:
+        shutil.rmtree(config.pkl_map_path)
+        os.makedirs(config.pkl_map_path)
+
+
+def time_stage(run, items, setup=None, repeats=3):
+    """
+    Returns timings for run, which processes items things, after an untimed
+    warm up run
+    """
+    times = []
+    for _ in range(repeats + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    times = times[1:]
+    median = statistics.median(times)
+    return {
+        "items": items,
+        "seconds": median,
+        "min_seconds": min(times),
+        "items_per_second": items / median if median else None,
+    }
+
+
+def run_benchmarks(maps, hit_objects, users, replays_per_user, repeats, seed, with_model=True):
+    rng = np.random.default_rng(seed)
+    stages = {}
+
+    def stage(name, run, items, setup=None):
+        stages[name] = time_stage(run, items, setup, repeats)
+        print(f"{name}: {stages[name]['seconds']:.4f}s, {stages[name]['items_per_second']:.1f} items/sec")
+
+    for path in (config.REPLAY_PATH, config.REPLAY_FEATURE_PATH, config.pkl_map_path):
+        os.makedirs(path, exist_ok=True)
+    md5s = create_maps(rng, maps, hit_objects)
+    replays = create_replays(rng, md5s, users, replays_per_user)
+    osr_data = [data for _, _, data in replays]
+    import_replays(replays)
+
+    # replay parsing
+    stage("FastReplay.parse", lambda: [fast_replay.FastReplay.parse(data) for data in osr_data], len(osr_data))
+
+    parsed = [fast_replay.FastReplay.parse(data) for data in osr_data]
+    action_data = [lzma.decompress(_compressed_actions(data)) for data in osr_data]
+    stage("_parse_actions", lambda: [fast_replay._parse_actions(data) for data in action_data], len(action_data))
+
+    # frame loading, from a file per replay and from the packed frame stores
+    with db.db:
+        db_replays = list(db.Replay.select())
+        stage("Replay.load_frames (files)", lambda: [replay.load_frames() for replay in db_replays], len(db_replays))
+        for user in db.User.select():
+            frame_store.pack_user_frames(user)
+        stage("Replay.load_frames (frame store)", lambda: [replay.load_frames() for replay in db_replays], len(db_replays))
+
+    # map loading. Cold parses .osu files, warm reads the per mod pickles in
+    # the map cache
+    map_mods = sorted({_map_key(replay) for replay in parsed})
+    def load_maps():
+        return [
+            beatmap.get_beatmap(md5, dt=dt, hd=hd, hr=hr, ez=ez, ht=ht)
+            for md5, dt, hd, hr, ez, ht in map_mods
+        ]
+    stage("get_beatmap (cold)", load_maps, len(map_mods), setup=lambda: clear_map_caches(pickles=True))
+    stage("get_beatmap (warm)", load_maps, len(map_mods), setup=clear_map_caches)
+    beatmap.pack_map_store(md5s)
+    stage("get_beatmap (map store)", load_maps, len(map_mods), setup=clear_map_caches)
+
+    # feature extraction
+    map_data = {key: data for key, data in zip(map_mods, load_maps())}
+    click_inputs = []
+    for replay in parsed:
+        key = _map_key(replay)
+        clicks = np.copy(replay.actions)
+        if replay.double_time:
+            clicks[:, frame.TIME] *= 2/3
+        elif replay.half_time:
+            clicks[:, frame.TIME] *= 4/3
+        click_inputs.append((clicks, map_data[key].hit_objects))
+    stage(
+        "replay_features.hit_object_clicks",
+        lambda: [replay_features.hit_object_clicks(clicks, hit_objects) for clicks, hit_objects in click_inputs],
+        len(click_inputs))
+    batch_inputs = (
+        [replay.actions for replay in parsed],
+        [map_data[_map_key(replay)] for replay in parsed],
+        [replay.double_time for replay in parsed],
+        [replay.half_time for replay in parsed],
+    )
+    stage(
+        "replay_features.click_features_batch",
+        lambda: replay_features.click_features_batch(*batch_inputs),
+        len(parsed))
+
+    # training data
+    unique_maps = list(map_data.values())
+    stage(
+        "dataset.note_features",
+        lambda: [dataset.note_features(data) for data in unique_maps],
+        len(unique_maps))
+    batches = [(user_id, batch) for user_id, batch, _, _ in dataset.user_batches()]
+    stage(
+        "dataset.user_batch_dataset",
+        lambda: [dataset.user_batch_dataset(user_id, batch) for user_id, batch in batches],
+        len(batches) * config.REPLAYS_PER_BATCH)
+    fit_data = [dataset._user_batch_data(user_id, batch)[2:4] for user_id, batch in batches]
+    stage(
+        "dataset.linear_fit",
+        lambda: [dataset.linear_fit(hit_errors, difficulty) for hit_errors, difficulty in fit_data],
+        len(fit_data))
+    fit_offsets = np.cumsum([0] + [len(hit_errors) for hit_errors, _ in fit_data])
+    fit_inputs = (
+        np.concatenate([hit_errors for hit_errors, _ in fit_data]),
+        np.concatenate([difficulty for _, difficulty in fit_data]),
+    )
+    stage("dataset.linear_fits", lambda: dataset.linear_fits(*fit_inputs, fit_offsets), len(fit_data))
+
+    # map evaluation
+    if with_model:
+        from osu_ml_difficulty import difficulty_model, map_difficulty, numpy_model
+        # untrained, but evaluation costs the same
+        model = difficulty_model.create_model()
+        stage(
+            "map_difficulty.evaluate_map",
+            lambda: [map_difficulty.evaluate_map(model, data) for data in unique_maps],
+            len(unique_maps))
+        numpy_model.export(model, "model.npz")
+        exported = numpy_model.load_model("model.npz")
+        stage(
+            "map_difficulty.evaluate_map (numpy)",
+            lambda: [map_difficulty.evaluate_map(exported, data) for data in unique_maps],
+            len(unique_maps))
+        difficulties = [map_difficulty.evaluate_map(model, data) for data in unique_maps]
+        stage(
+            "map_difficulty.get_map_required_skill",
+            lambda: [map_difficulty.get_map_required_skill(d) for d in difficulties],
+            len(difficulties))
+        stage(
+            "map_difficulty.get_map_required_skills",
+            lambda: map_difficulty.get_map_required_skills(difficulties),
+            len(difficulties))
+
+    return stages
+
+
+def _compressed_actions(data):
+    """
+    The lzma compressed action stream of .osr data
+    """
+    reader = fast_replay._Reader(data)
+    reader.byte()
+    reader.int()
+    for _ in range(3):
+        reader.string()
+    for _ in range(6):
+        reader.short()
+    reader.int()
+    reader.short()
+    reader.byte()
+    reader.int()
+    reader.string()
+    reader.datetime()
+    return reader.bytes(reader.int())
+
+
+def compare(stages, settings, previous):
+    """
+    Print the speedup of each stage's throughput against previous results
+    """
+    print(f"\nCompared to {previous.get('commit')}:")
+    if previous["settings"] != settings:
+        print(f"Warning: previous run used different settings: {previous['settings']}")
+    for name, result in stages.items():
+        previous_name = name if name in previous["stages"] else RENAMED_STAGES.get(name)
+        if previous_name in previous["stages"]:
+            speedup = result["items_per_second"] / previous["stages"][previous_name]["items_per_second"]
+            print(f"{name}: {speedup:.2f}x")
+
+
+@click.command()
+@click.option("--output", "-o", default="benchmark.json", type=click.Path(),
+              help="Path to write JSON results to")
+@click.option("--compare", "compare_path", default=None, type=click.Path(exists=True),
+              help="JSON results from a previous run to compare against")
+@click.option("--maps", default=20, type=int, help="Number of synthetic maps")
+@click.option("--hit-objects", default=400, type=int, help="Hit objects per map")
+@click.option("--users", default=1, type=int, help="Number of synthetic users")
+@click.option("--replays-per-user", default=config.REPLAYS_PER_BATCH, type=int,
+              help="Replays per user")
+@click.option("--repeats", default=3, type=int, help="Timed runs of each stage")
+@click.option("--model/--no-model", "with_model", default=True,
+              help="Benchmark map evaluation, which needs tensorflow")
+@click.option("--seed", default=0, type=int)
+def main(output, compare_path, maps, hit_objects, users, replays_per_user, repeats, with_model, seed):
+    output = os.path.abspath(output)
+    previous = None
+    if compare_path is not None:
+        with open(compare_path) as previous_file:
+            previous = json.load(previous_file)
+
+    settings = dict(
+        maps=maps, hit_objects=hit_objects, users=users, replays_per_user=replays_per_user,
+        repeats=repeats, seed=seed)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # config paths are relative, with maps in ../osu_files
+        run_dir = os.path.join(tmp_dir, "run")
+        os.makedirs(run_dir)
+        os.chdir(run_dir)
+        try:
+            stages = run_benchmarks(with_model=with_model, **settings)
+        finally:
+            db.db.close()
+            os.chdir(cwd)
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+        "stages": stages,
+    }
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Wrote {output}")
+
+    if previous is not None:
+        compare(stages, settings, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Compare FastReplay.parse against the previous parser, which consumed a
+bytearray with slider's consume_* helpers and parsed actions with pandas.
+
+    python -m benchmarks.replay_parsing
+"""
+
+import io
+import lzma
+import time
+
+import numpy as np
+import pandas as pd
+from slider.utils import consume_byte, consume_short, consume_int, consume_string, consume_datetime
+
+from osu_ml_difficulty import fast_replay
+from benchmarks.synthetic import osr_bytes
+
+
+def legacy_parse(data):
+    buffer = bytearray(data)
+    consume_byte(buffer)
+    consume_int(buffer)
+    for _ in range(3):
+        consume_string(buffer)
+    for _ in range(6):
+        consume_short(buffer)
+    consume_int(buffer)
+    consume_short(buffer)
+    consume_byte(buffer)
+    consume_int(buffer)
+    consume_string(buffer)
+    consume_datetime(buffer)
+    compressed_byte_count = consume_int(buffer)
+    compressed_data = buffer[:compressed_byte_count]
+    del buffer[:compressed_byte_count]
+    raw_actions = pd.read_csv(
+        io.StringIO(lzma.decompress(compressed_data).decode("ascii")),
+        delimiter="|",
+        lineterminator=",",
+        dtype="f",
+        header=None
+    ).to_numpy()
+    return fast_replay._click_frames(raw_actions)
+
+
+def replays_per_second(parse, replays):
+    start = time.perf_counter()
+    for data in replays:
+        parse(data)
+    return len(replays) / (time.perf_counter() - start)
+
+
+def main(count=50):
+    rng = np.random.default_rng(0)
+    replays = [osr_bytes(rng) for _ in range(count)]
+
+    for data in replays:
+        expected = legacy_parse(data)
+        actual = fast_replay.FastReplay.parse(data).actions
+        np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-6)
+
+    legacy = replays_per_second(legacy_parse, replays)
+    fast = replays_per_second(fast_replay.FastReplay.parse, replays)
+    print(f"legacy parser: {legacy:.1f} replays/sec")
+    print(f"FastReplay.parse: {fast:.1f} replays/sec ({fast/legacy:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
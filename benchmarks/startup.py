@@ -0,0 +1,64 @@
+"""
+Time CLI startup, and check that modules used by commands which don't need
+tensorflow don't import it. Exits with an error if --help takes longer than
+the limit, or if any of those modules import tensorflow.
+
+    python -m benchmarks.startup
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+
+HELP_TIME_LIMIT = 1.0
+
+# modules used by extract-replay-features, pack-replay-features, pack-maps,
+# build-training-cache and import_replay_data.py
+NON_TF_MODULES = [
+    "osu_ml_difficulty.replay_features",
+    "osu_ml_difficulty.beatmap",
+    "osu_ml_difficulty.dataset",
+    "osu_ml_difficulty.db",
+]
+
+
+def run_python(*args):
+    """
+    Returns (seconds, imported modules) for running python in a new interpreter
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        env=env, capture_output=True, text=True, check=True
+    )
+    elapsed = time.perf_counter() - start
+    modules = {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+    return elapsed, modules
+
+
+def main(repeats=5):
+    failures = []
+
+    times = sorted(run_python("-m", "osu_ml_difficulty", "--help")[0] for _ in range(repeats))
+    median = times[len(times) // 2]
+    print(f"--help: {median:.2f}s (median of {repeats})")
+    if median > HELP_TIME_LIMIT:
+        failures.append(f"--help took {median:.2f}s, over the {HELP_TIME_LIMIT}s limit")
+
+    for module in NON_TF_MODULES:
+        elapsed, modules = run_python("-c", f"import {module}")
+        print(f"import {module}: {elapsed:.2f}s")
+        if "tensorflow" in modules:
+            failures.append(f"{module} imports tensorflow")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Synthetic data for benchmarks, so they can run without any downloaded replays
+or beatmaps
+"""
+
+import datetime
+import lzma
+import struct
+
+import numpy as np
+
+from osu_ml_difficulty.fast_replay import Buttons
+
+
+def _string(value):
+    if value is None:
+        return b"\x00"
+    data = value.encode("utf-8")
+    length = bytearray()
+    n = len(data)
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            length.append(byte | 0x80)
+        else:
+            length.append(byte)
+            break
+    return b"\x0b" + bytes(length) + data
+
+
+def action_text(rng, duration_ms=180000, frame_ms=16, click_interval_ms=150):
+    """
+    Returns ``w|x|y|z,`` action text for a cursor wandering around the playfield,
+    alternating K1 and K2 presses
+    """
+    n_frames = duration_ms // frame_ms
+    time_deltas = np.full(n_frames, frame_ms)
+    time_deltas[:2] = 0
+    time_deltas[2] = -1
+    positions = np.cumsum(rng.normal(0, 8, (n_frames, 2)), axis=0) + [256, 192]
+    positions = np.abs(np.mod(positions, [1024, 768]) - [512, 384])
+
+    times = np.cumsum(time_deltas)
+    click_index = times // click_interval_ms
+    pressed = (times % click_interval_ms) < 50
+    buttons = np.where(pressed, np.where(click_index % 2 == 0, int(Buttons.K1), int(Buttons.K2)), 0)
+
+    frames = [
+        f"{w}|{x:.4f}|{y:.4f}|{z}"
+        for w, (x, y), z in zip(time_deltas, positions, buttons)
+    ]
+    frames.append(f"-12345|0|0|{rng.integers(1 << 30)}")
+    return ",".join(frames) + ","
+
+
+def played_action_text(rng, times, positions, frame_ms=16, timing_error_ms=15, aim_error=8, hold_ms=60):
+    """
+    Returns ``w|x|y|z,`` action text for a player clicking each hit object at
+    times (ms) and positions, with normally distributed timing and aim errors.
+    The cursor moves in straight lines between clicks, and keys alternate.
+    """
+    press_times = np.sort(np.round(times + rng.normal(0, timing_error_ms, len(times))))
+    targets = positions + rng.normal(0, aim_error, positions.shape)
+    release_times = press_times + hold_ms
+
+    grid = np.arange(press_times[0] - 1000, press_times[-1] + 1000, frame_ms)
+    frame_times = np.unique(np.concatenate((grid, press_times, release_times)))
+    x = np.interp(frame_times, press_times, targets[:, 0])
+    y = np.interp(frame_times, press_times, targets[:, 1])
+
+    # the most recent press is held until it's released or the next key is pressed
+    last_press = np.searchsorted(press_times, frame_times, side="right") - 1
+    held = (last_press >= 0) & (frame_times < release_times[np.maximum(last_press, 0)])
+    keys = np.where(last_press % 2 == 0, int(Buttons.K1), int(Buttons.K2))
+    buttons = np.where(held, keys, 0)
+
+    time_deltas = np.diff(frame_times, prepend=0).astype(int)
+    frames = ["0|256|-500|0", "-1|256|-500|0"]
+    frames += [
+        f"{w}|{x:.4f}|{y:.4f}|{z}"
+        for w, x, y, z in zip(time_deltas, x, y, buttons)
+    ]
+    frames.append(f"-12345|0|0|{rng.integers(1 << 30)}")
+    return ",".join(frames) + ","
+
+
+def osr_bytes(rng, beatmap_md5="0" * 32, player_name="synthetic", mods=0,
+              timestamp=datetime.datetime(2020, 1, 1), actions=None, **action_kwargs):
+    """
+    Returns the contents of an osu!standard ``.osr`` file, with the given
+    action text or a wandering cursor from action_text
+    """
+    if actions is None:
+        actions = action_text(rng, **action_kwargs)
+    compressed_actions = lzma.compress(actions.encode("ascii"), format=lzma.FORMAT_ALONE)
+    ticks = int((timestamp - datetime.datetime(1, 1, 1)).total_seconds() * 1e7)
+    return b"".join((
+        struct.pack("<BI", 0, 20200101),
+        _string(beatmap_md5),
+        _string(player_name),
+        _string("f" * 32),
+        struct.pack("<HHHHHHIHBI", 1000, 20, 2, 100, 10, 1, 12345678, 1200, 0, mods),
+        _string(""),
+        struct.pack("<QI", ticks, len(compressed_actions)),
+        compressed_actions,
+        struct.pack("<q", 0),
+    ))
+
+
+def osu_text(rng, index=0, hit_object_count=400):
+    """
+    Returns the contents of a standard mode ``.osu`` file with circles,
+    stacks, linear, bezier and perfect curve sliders, and spinners
+    """
+    ms_per_beat = float(rng.choice([250, 300, 333.333, 400]))
+    lines = [
+        "osu file format v14", "",
+        "[General]", "AudioFilename: audio.mp3", "StackLeniency: 0.7", "Mode: 0", "",
+        "[Metadata]", f"Title:Map{index}", f"Artist:Artist{index}", "Creator:synthetic",
+        f"Version:Diff{index}", f"BeatmapID:{1000 + index}", f"BeatmapSetID:{index}", "",
+        "[Difficulty]", "HPDrainRate:5", f"CircleSize:{rng.uniform(3, 5):.1f}",
+        f"OverallDifficulty:{rng.uniform(7, 9):.1f}", f"ApproachRate:{rng.uniform(8, 10):.1f}",
+        "SliderMultiplier:1.4", "SliderTickRate:1", "",
+        "[TimingPoints]", f"0,{ms_per_beat},4,2,0,50,1,0", "30000,-75,4,2,0,50,0,0",
+        "60000,-100,4,2,0,50,0,0", "",
+        "[HitObjects]",
+    ]
+
+    time = 1000
+    x, y = 256, 192
+    for i in range(hit_object_count):
+        kind = rng.random()
+        if kind < 0.1 and i:
+            # stack on the previous object
+            pass
+        else:
+            angle = rng.uniform(0, 2 * np.pi)
+            distance = rng.uniform(0, 200)
+            x = int(np.clip(x + distance * np.cos(angle), 0, 512))
+            y = int(np.clip(y + distance * np.sin(angle), 0, 384))
+
+        if kind < 0.7:
+            lines.append(f"{x},{y},{time},1,0,0:0:0:0:")
+            time += int(ms_per_beat * rng.choice([0.5, 0.5, 1]))
+        elif kind < 0.98:
+            curve = rng.choice(["L", "B", "P"])
+            point_count = {"L": 1, "B": 3, "P": 2}[curve]
+            points = np.array([[x, y]])
+            while (points == [x, y]).all(axis=1).any():
+                # control points on the start make zero length curves
+                points = np.clip(
+                    [x, y] + rng.normal(0, 60, (point_count, 2)), [0, 0], [512, 384]).astype(int)
+            length = rng.uniform(40, 200)
+            repeat = int(rng.choice([1, 1, 2]))
+            point_text = "|".join(f"{px}:{py}" for px, py in points)
+            lines.append(f"{x},{y},{time},2,0,{curve}|{point_text},{repeat},{length:.2f}")
+            time += int(ms_per_beat * (repeat + 1))
+        else:
+            lines.append(f"256,192,{time},12,0,{time + 2000},0:0:0:0:")
+            time += 2000 + int(ms_per_beat)
+
+    return "\n".join(lines) + "\n"
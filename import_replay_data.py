@@ -4,13 +4,15 @@ Import replay files and store in binary format
 
 import os
 from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import logging
 
-from peewee import fn
+import click
+from peewee import fn, chunked
 import numpy as np
 import pandas as pd
 
-from osu_ml_difficulty import db, config
+from osu_ml_difficulty import db, config, beatmap, metrics, replay_features
 from osu_ml_difficulty.fast_replay import FastReplay, GameModeNotSupported
 
 USERS_FILENAME = os.path.join(config.DOWNLOAD_PATH, "users.csv")
@@ -47,11 +49,14 @@ def import_users():
 
     return pending_users, responses
 
-def import_replays():
+def import_replays(extract_features=False, save_frames=True, pack_frames=False, remove_files=False):
     pending_users, _ = import_users()
 
     for user in pending_users:
-        parse_replays(user)
+        parse_replays(user, extract_features=extract_features, save_frames=save_frames)
+        if save_frames and pack_frames:
+            with db.db, metrics.timer("pack_frames"):
+                replay_features.pack_user_frames(user, remove_files=remove_files)
 
 
 def replay_paths(replay_dir):
@@ -69,34 +74,137 @@ def parse_replay(replay_path):
         logging.exception("error parsing replay")
         return None
 
-def parse_replays(user, processes=4):
+def save_replay_features(replay, filename):
+    """
+    Calculate and save features for a freshly parsed replay, as
+    extract-replay-features would. Returns False if its beatmap can't be found
+    """
+    try:
+        map_data = beatmap.get_beatmap(
+            replay.beatmap_md5,
+            dt=replay.double_time, hd=replay.hidden, hr=replay.hard_rock, ez=replay.easy, ht=replay.half_time
+        )
+    except KeyError:
+        return False
+
+    features = replay_features.click_features(
+        np.copy(replay.actions), map_data, dt=replay.double_time, ht=replay.half_time)
+    if features is not None:
+        replay_features.save_features(os.path.join(config.REPLAY_FEATURE_PATH, filename), features)
+    return True
+
+def import_replay(replay_path, username, extract_features=False, save_frames=True):
+    """
+    Parse a replay and save its frames, and optionally its features.
+
+    Returns the fields for its db row (without user), so that only small
+    records need to be sent back from worker processes
+    """
+    with metrics.timer("parse_replay"):
+        replay = parse_replay(replay_path)
+    if replay is None:
+        metrics.inc("replays_unparsed")
+        return None
+
+    filename = f"{username}-{replay.beatmap_md5}-{replay.timestamp.strftime('%Y-%m-%d_%H-%M-%S.%f')}.npy"
+    if save_frames:
+        with metrics.timer("save_frames"):
+            np.save(os.path.join(config.REPLAY_PATH, filename), replay.actions)
+    if extract_features:
+        try:
+            with metrics.timer("extract_features"):
+                if not save_replay_features(replay, filename):
+                    metrics.inc("replays_missing_beatmap")
+        except Exception:
+            metrics.inc("feature_errors")
+            logging.exception("Failed to extract features from replay: %s", replay_path)
+
+    return dict(
+        mods=replay.difficulty_mods(),
+        beatmap_md5=replay.beatmap_md5,
+        timestamp=replay.timestamp,
+        filename=filename,
+        count_300=replay.count_300,
+        count_100=replay.count_100,
+        count_50=replay.count_50,
+        count_miss=replay.count_miss,
+        max_combo=replay.max_combo,
+        score=replay.score
+    )
+
+def insert_replays(rows):
+    # keep each statement under sqlite's default limit of 999 variables
+    with metrics.timer("insert_replays"):
+        for batch in chunked(rows, 999 // len(db.Replay._meta.fields)):
+            db.Replay.insert_many(batch).execute()
+    metrics.inc("replays_imported", len(rows))
+
+def parse_replays(user, processes=4, insert_batch_size=1000, extract_features=False, save_frames=True):
+    """
+    Import all replays for a user.
+
+    Replays are parsed and saved by worker processes, and inserted into the db
+    in batches. All of a user's replays are added in a single transaction, so
+    an interrupted import leaves the user pending.
+
+    With extract_features, workers also calculate hit features in the same
+    pass, so extract-replay-features doesn't need to read the frames back.
+    """
     path = os.path.join(config.DOWNLOAD_PATH, user.username)
+    import_func = partial(
+        import_replay,
+        username=user.username,
+        extract_features=extract_features,
+        save_frames=save_frames
+    )
 
     with db.db:
         i=0
+        rows = []
         with ProcessPoolExecutor(processes) as executor:
-            for replay in executor.map(parse_replay, replay_paths(path), chunksize=100):
-                if replay is not None:
-                    filename = f"{user.username}-{replay.beatmap_md5}-{replay.timestamp.strftime('%Y-%m-%d_%H-%M-%S.%f')}.npy"
-                    np.save(os.path.join(config.REPLAY_PATH, filename), replay.actions)
-                    db.Replay.create(
-                        user=user,
-                        mods=replay.difficulty_mods(),
-                        beatmap_md5=replay.beatmap_md5,
-                        timestamp=replay.timestamp,
-                        filename=filename,
-                        count_300=replay.count_300,
-                        count_100=replay.count_100,
-                        count_50=replay.count_50,
-                        count_miss=replay.count_miss,
-                        max_combo=replay.max_combo,
-                        score=replay.score
-                    )
+            results = executor.map(partial(metrics.collecting, import_func), replay_paths(path), chunksize=100)
+            for row in metrics.merged(results):
+                if row is not None:
+                    rows.append(dict(row, user=user.id))
+                    if len(rows) >= insert_batch_size:
+                        insert_replays(rows)
+                        rows = []
                     i+=1
                     if i % 500 == 0:
                         print(f"Parsing replays for {user.username}: {i}")
+            insert_replays(rows)
             print(f"Parsing replays for {user.username}: {i}")
 
 
+@click.command()
+@click.option("--extract-features/--no-extract-features", default=False,
+              help="Extract hit features while importing, instead of with extract-replay-features")
+@click.option("--save-frames/--no-save-frames", default=True,
+              help="Save click frames. Without them, features can't be recalculated later")
+@click.option("--pack-frames/--no-pack-frames", default=False,
+              help="Pack each user's click frames into a compact store once their replays are imported, see pack-replay-frames. "
+                   "Can't be used with --extract-features, run extract-replay-features afterwards instead")
+@click.option("--remove-files/--keep-files", default=False,
+              help="With --pack-frames, delete each replay's frame file once it's packed")
+@click.option("--metrics", "metrics_path", default=None, type=click.Path(),
+              help="Periodically write metrics to this file, as Prometheus text if it ends in .prom, otherwise JSON")
+@click.option("--metrics-interval", default=10.0, type=float,
+              help="Seconds between metrics writes (default: 10)")
+def main(extract_features, save_frames, pack_frames, remove_files, metrics_path, metrics_interval):
+    if not save_frames and not extract_features:
+        raise click.UsageError("--no-save-frames requires --extract-features")
+    if pack_frames and not save_frames:
+        raise click.UsageError("--pack-frames can't be used with --no-save-frames")
+    if pack_frames and extract_features:
+        # features extracted while importing come from the unpacked frames, so
+        # would all be extracted again from the packed ones
+        raise click.UsageError(
+            "--pack-frames can't be used with --extract-features, run extract-replay-features after importing")
+    if remove_files and not pack_frames:
+        raise click.UsageError("--remove-files requires --pack-frames")
+    metrics.start(metrics_path, metrics_interval)
+    import_replays(
+        extract_features=extract_features, save_frames=save_frames, pack_frames=pack_frames, remove_files=remove_files)
+
 if __name__ == "__main__":
-    import_replays()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,43 +1,236 @@
 import click
-from . import difficulty_model, replay_features, map_difficulty
+
+# subcommands import what they need when they run, so that startup and --help
+# don't pay for importing tensorflow and numba
 
 
 @click.group()
-def main():
-    pass
+@click.option("--metrics", "metrics_path", default=None, type=click.Path(),
+              help="Periodically write metrics to this file, as Prometheus text if it ends in .prom, otherwise JSON")
+@click.option("--metrics-interval", default=10.0, type=float,
+              help="Seconds between metrics writes (default: 10)")
+def main(metrics_path, metrics_interval):
+    from . import metrics
+    metrics.start(metrics_path, metrics_interval)
 
 
 @main.command()
 @click.argument("filename", default="model.keras")
 @click.option("--batch-count", "-b", default=None, type=int,
-              help="Amount of data batches to train with (default: all)")
-def train(filename, batch_count):
+              help="Amount of data batches to train with each epoch (default: all)")
+@click.option("--epochs", "-e", default=1, type=int,
+              help="Number of epochs to train for (default: 1)")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of data parallel training processes (default: 1)")
+@click.option("--batch-size", default=1024, type=int,
+              help="Examples per training step, over all workers (default: 1024)")
+def train(filename, batch_count, epochs, workers, batch_size):
     """
-    Train a model
+    Train a model. Checkpoints are saved after each epoch, so an interrupted run
+    resumes when run again.
     """
-    difficulty_model.fit(filename, batch_count)
+    from . import difficulty_model
+    difficulty_model.fit(filename, batch_count, epochs=epochs, workers=workers, batch_size=batch_size)
 
 
 @main.command()
 @click.option("--force/--no-force", "-f", default=False,
               help="Recalculate all features even if they already exist")
-def extract_replay_features(force):
+@click.option("--force-version", default=None, type=int,
+              help="Recalculate features extracted by this feature version")
+@click.option("--retry-failed/--no-retry-failed", default=False,
+              help="Retry replays whose beatmap was missing or which raised an error")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of worker processes (default: 1)")
+def extract_replay_features(force, force_version, retry_failed, workers):
+    """
+    Extract hit information from replays. Required before running training.
+    Can be interrupted and resumed.
+    """
+    from . import replay_features
+    replay_features.calculate_all_replay_features(
+        force=force, workers=workers, force_version=force_version, retry_failed=retry_failed)
+
+
+@main.command()
+@click.option("--remove-files/--keep-files", default=False,
+              help="Delete the per-replay feature files once packed")
+def pack_replay_features(remove_files):
+    """
+    Pack extracted features into one memory mapped file per user, so training
+    doesn't need to open a file for every replay
+    """
+    from . import replay_features
+    replay_features.pack_all_replay_features(remove_files=remove_files)
+
+@main.command()
+@click.option("--remove-files/--keep-files", default=False,
+              help="Delete the per-replay frame files once packed")
+@click.option("--velocities/--no-velocities", default=True,
+              help="Keep cursor velocities, which are only used for the velocity feature columns")
+def pack_replay_frames(remove_files, velocities):
+    """
+    Pack click frames into one compact memory mapped file per user, so they
+    take less space and extraction doesn't need to open a file per replay
+    """
+    from . import db, replay_features
+    with db.db:
+        for user in db.User.select():
+            count = replay_features.pack_user_frames(user, remove_files=remove_files, velocities=velocities)
+            print(f"Packed frames for {user.username}: {count} replays")
+
+@main.command()
+@click.option("--all-maps/--replay-maps", default=False,
+              help="Pack every map in the library, rather than only maps with replays")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of worker processes (default: 1)")
+def pack_maps(all_maps, workers):
+    """
+    Parse maps into a single mod independent store, which replaces the
+    per mod pickles in the map cache
+    """
+    from . import beatmap, db
+    md5s = beatmap.get_library().md5s if all_maps else db.replay_beatmap_md5s()
+    count = beatmap.pack_map_store(md5s, workers=workers)
+    print(f"Packed {count} maps")
+
+@main.command()
+@click.option("--force/--no-force", "-f", default=False,
+              help="Rebuild all cached batches even if they already exist")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of worker processes (default: 1)")
+def build_training_cache(force, workers):
+    """
+    Precompute training data for every user batch, so epochs don't repeat the
+    preprocessing. Stale batches are rebuilt automatically.
+    """
+    from . import dataset
+    dataset.build_training_cache(force=force, workers=workers)
+
+@main.command()
+@click.option("--force/--no-force", "-f", default=False,
+              help="Refit all batches even if their fits are up to date")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of worker processes loading batches (default: 1)")
+def fit_skills(force, workers):
     """
-    Extract hit information from replays. Required before running training
+    Fit the skill of every user batch and store it in the db, so training
+    doesn't refit it whenever a batch is loaded. Stale fits are refitted
+    automatically.
     """
-    replay_features.calculate_all_replay_features(force=force)
+    from . import dataset
+    dataset.fit_batch_skills(force=force, workers=workers)
+
+@main.command()
+@click.argument("username", required=False)
+def batch_skills(username):
+    """
+    Print the fitted skill of each user batch as csv, for USERNAME or every user
+    """
+    from . import db
+    query = (db.BatchSkill
+        .select(db.BatchSkill, db.User.username)
+        .join(db.User)
+        .order_by(db.User.username, db.BatchSkill.batch))
+    if username is not None:
+        query = query.where(db.User.username == username)
+    print("username", "batch", "timestamp", "m", "c", "hit_objects", sep=",")
+    with db.db:
+        for skill in query:
+            print(skill.user.username, skill.batch, skill.timestamp.isoformat(), skill.m, skill.c, skill.hit_objects, sep=",")
+
+@main.command()
+@click.argument("model_path", default="model.keras", type=click.Path(exists=True))
+@click.argument("output", default="model.npz")
+def export(model_path, output):
+    """
+    Export a model to a .npz file, which map-list and serve evaluate with numpy
+    instead of tensorflow, e.g. --model_path model.npz
+    """
+    from . import difficulty_model, numpy_model
+    numpy_model.export(difficulty_model.load_model(model_path), output)
+    print(f"Exported {model_path} to {output}")
+
+@main.command()
+@click.option("--cache/--no-cache", default=True,
+              help="Read batches from the training cache where available")
+@click.option("--examples", "-n", default=1000000, type=int,
+              help="Number of examples to read")
+def input_throughput(cache, examples):
+    """
+    Measure training input pipeline throughput
+    """
+    from . import dataset
+    count, rate = dataset.measure_throughput(dataset.make_training_dataset(use_cache=cache), examples)
+    print(f"Read {count} examples: {rate:.0f} examples/sec")
 
 @main.command()
 @click.argument("map_csv", type=click.Path(exists=True))
 @click.option("--model_path", type=click.Path(exists=True), default="model.keras",
-              help="Path to model")
-def map_list(map_csv, model_path):
+              help="Path to model, either keras or exported .npz")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of worker processes loading maps (default: 1)")
+@click.option("--maps-per-batch", default=256, type=int,
+              help="Number of maps evaluated per model call")
+@click.option("--cache/--no-cache", default=True,
+              help="Reuse results for maps this model has already evaluated, and store new ones")
+@click.option("--output", "-o", default=None, type=click.Path(),
+              help="Write results to a .csv, or with note difficulties to a .parquet or .arrow file, instead of printing them")
+def map_list(map_csv, model_path, workers, maps_per_batch, cache, output):
     """
     map_csv:  Path to csv map list. Must contain 'ID' and 'Mods' columns"
     """
+    from . import map_difficulty
+    map_difficulty.map_required_skills_from_csv(map_csv, model_path, workers, maps_per_batch, use_cache=cache, output=output)
 
-    map_difficulty.map_required_skills_from_csv(map_csv, model_path)
 
 
+@main.command()
+@click.argument("output", default="library.csv")
+@click.option("--model_path", type=click.Path(exists=True), default="model.keras",
+              help="Path to model, either keras or exported .npz")
+@click.option("--mods", "-m", multiple=True, default=("nomod", "hr", "dt"),
+              help="Mod combination to score each map with, e.g. hd+dt. Repeat for several (default: nomod, hr, dt)")
+@click.option("--workers", "-w", default=1, type=int,
+              help="Number of worker processes loading maps (default: 1)")
+@click.option("--maps-per-batch", default=256, type=int,
+              help="Number of maps evaluated per model call, and between checkpoints")
+@click.option("--restart/--resume", default=False,
+              help="Start again rather than resuming an interrupted run")
+def rank_library(output, model_path, mods, workers, maps_per_batch, restart):
+    """
+    Score every standard mode map in the library with each mod combination,
+    writing csv to OUTPUT. Can be interrupted and resumed.
+    """
+    from . import rank_library
+    try:
+        mod_sets = rank_library.parse_mod_sets(mods)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--mods")
+    try:
+        rank_library.rank_library(output, mod_sets, model_path, workers, maps_per_batch, restart)
+    except rank_library.CheckpointMismatch as e:
+        raise click.ClickException(str(e))
+
+
+@main.command()
+@click.option("--model_path", type=click.Path(exists=True), default="model.keras",
+              help="Path to model, either keras or exported .npz")
+@click.option("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+@click.option("--port", "-p", default=8000, type=int, help="Port to listen on (default: 8000)")
+@click.option("--max-maps", default=256, type=int,
+              help="Most maps evaluated per model call")
+@click.option("--max-delay-ms", default=5.0, type=float,
+              help="How long to wait for more requests to evaluate together (default: 5)")
+def serve(model_path, host, port, max_maps, max_delay_ms):
+    """
+    Serve map difficulties over HTTP, keeping the model and maps loaded
+    between requests, e.g. GET /difficulty?id=<beatmap id>&mods=hd+dt
+    """
+    from . import server
+    server.serve(model_path, host, port, max_maps, max_delay_ms / 1000)
+
 
-main()
+# worker processes started with spawn import this module as __mp_main__
+if __name__ == "__main__":
+    main()
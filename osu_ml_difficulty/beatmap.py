@@ -1,5 +1,12 @@
 import os
+import copy
+import logging
+import pathlib
+import sqlite3
+import threading
+from contextlib import closing
 from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import slider
@@ -7,18 +14,35 @@ from slider.mod import circle_radius
 
 from osu_ml_difficulty import config
 from osu_ml_difficulty.pickle_memoize import pickle_memoize
-from osu_ml_difficulty import frame
+from osu_ml_difficulty import frame, map_store
+from osu_ml_difficulty.osu_file import OsuFile
 
 
-lib = slider.Library(config.OSU_MAP_PATH, cache=128)
+_local = threading.local()
+
+def get_library():
+    """
+    The slider library, created on first use in each process and thread.
+    Creating it opens its sqlite db, which can't be shared with forked worker
+    processes or other threads.
+    """
+    if getattr(_local, "library_pid", None) != os.getpid():
+        _local.library = slider.Library(config.OSU_MAP_PATH, cache=128)
+        _local.library_pid = os.getpid()
+    return _local.library
+
+# increment when MapData contents change, to invalidate data derived from it
+MAP_DATA_VERSION = 3
 
 
 class MapData:
-    __slots__=("hit_objects", "scale", "beatmap_id", "beatmap_name", "dt", "hd", "hr", "ez", "ht")
+    __slots__=("hit_objects", "scale", "od", "beatmap_id", "beatmap_name", "dt", "hd", "hr", "ez", "ht")
 
-    def __init__(self, hit_objects, scale, beatmap_id, beatmap_name, dt, hd, hr, ez, ht):
+    def __init__(self, hit_objects, scale, od, beatmap_id, beatmap_name, dt, hd, hr, ez, ht):
         self.hit_objects = hit_objects
         self.scale = scale
+        # with hr/ez applied, but not dt/ht, which scale hit_objects' times instead
+        self.od = od
         self.beatmap_id = beatmap_id
         self.beatmap_name = beatmap_name
         self.dt = dt
@@ -33,6 +57,43 @@ class MapData:
         result[:, frame.TIME] *= 1e-3
         return result
 
+    @classmethod
+    def from_store(cls, store: map_store.MapStore, beatmap_md5, dt=False, hd=False, hr=False, ez=False, ht=False):
+        hit_objects, cs, od, beatmap_id, beatmap_name = store.load(beatmap_md5, dt=dt, hr=hr, ez=ez, ht=ht)
+        return cls(
+            hit_objects=hit_objects,
+            scale=1/circle_radius(cs),
+            od=od,
+            beatmap_id=beatmap_id,
+            beatmap_name=beatmap_name,
+            dt=dt,
+            hd=hd,
+            hr=hr,
+            ez=ez,
+            ht=ht
+        )
+
+    @classmethod
+    def from_osu_file(cls, osu_file: OsuFile, dt=False, hd=False, hr=False, ez=False, ht=False):
+        times, positions = osu_file.hit_objects(hard_rock=hr)
+        time = times / 10**6 * 1e3
+        if dt:
+            time = map_store.scale_time(time, 2/3)
+        elif ht:
+            time = map_store.scale_time(time, 4/3)
+        return cls(
+            hit_objects=np.column_stack((time, positions)).astype("f"),
+            scale=1/circle_radius(osu_file.cs(easy=ez, hard_rock=hr)),
+            od=osu_file.od(easy=ez, hard_rock=hr),
+            beatmap_id=osu_file.beatmap_id,
+            beatmap_name=osu_file.display_name,
+            dt=dt,
+            hd=hd,
+            hr=hr,
+            ez=ez,
+            ht=ht
+        )
+
     @classmethod
     def from_beatmap(cls, beatmap: slider.Beatmap, dt=False, hd=False, hr=False, ez=False, ht=False):
         return cls(
@@ -43,6 +104,7 @@ class MapData:
                 )
             ], dtype="f"),
             scale=1/circle_radius(beatmap.cs(easy=ez, hard_rock=hr)),
+            od=beatmap.od(easy=ez, hard_rock=hr),
             beatmap_id=beatmap.beatmap_id,
             beatmap_name=beatmap.display_name,
             dt=dt,
@@ -55,15 +117,156 @@ class MapData:
 
 def beatmmap_pickle_path(beatmap_md5, **kwargs):
     mods = "".join(sorted([k for k,v in kwargs.items() if v]))
-    return os.path.join(config.pkl_map_path, f"{beatmap_md5}[{mods}].pkl")
+    return os.path.join(config.pkl_map_path, f"{beatmap_md5}[{mods}]-v{MAP_DATA_VERSION}.pkl")
+
+@lru_cache(1)
+def _library_table():
+    """
+    (md5 -> path, beatmap id -> md5) for every map in the library, read once
+    per process from the db slider keeps of it, as looking a map up in the
+    library itself parses the whole map
+    """
+    # creates the db if the library hasn't been set up yet
+    get_library()
+    db_uri = (pathlib.Path(config.OSU_MAP_PATH).resolve() / ".slider.db").as_uri() + "?mode=ro"
+    with closing(sqlite3.connect(db_uri, uri=True)) as connection:
+        rows = connection.execute("SELECT md5, id, path FROM beatmaps").fetchall()
+    paths = {md5: os.path.join(config.OSU_MAP_PATH, path) for md5, _, path in rows}
+    md5s = {beatmap_id: md5 for md5, beatmap_id, _ in rows if beatmap_id is not None}
+    return paths, md5s
+
+def beatmap_path(beatmap_md5):
+    return _library_table()[0][beatmap_md5]
+
+def beatmap_md5_from_id(beatmap_id):
+    return _library_table()[1][int(beatmap_id)]
+
+@lru_cache(128)
+def read_osu_file(beatmap_md5):
+    """
+    Returns the OsuFile for a map, or None if it has to be parsed by slider
+    """
+    path = beatmap_path(beatmap_md5)
+    try:
+        return OsuFile.from_path(path)
+    except Exception:
+        return None
+
+def _parse_beatmap(beatmap_md5, **kwargs):
+    osu_file = read_osu_file(beatmap_md5)
+    if osu_file is not None:
+        try:
+            return MapData.from_osu_file(osu_file, **kwargs)
+        except Exception:
+            # e.g. invalid slider curves. Let slider decide what to do with them
+            pass
+    # slider resolves stacking in place on its cached beatmap, so use a copy
+    # to avoid depending on which mods were loaded first
+    return MapData.from_beatmap(copy.deepcopy(get_library().lookup_by_md5(beatmap_md5)),**kwargs)
+
+parse_beatmap = pickle_memoize(beatmmap_pickle_path)(_parse_beatmap)
+
+def _from_store(beatmap_md5, **kwargs):
+    store = map_store.get_store(MAP_DATA_VERSION)
+    if store is not None and beatmap_md5 in store and not (kwargs.get("hr") and kwargs.get("ez")):
+        return MapData.from_store(store, beatmap_md5, **kwargs)
+    return None
 
 @lru_cache(256)
-@pickle_memoize(beatmmap_pickle_path)
 def get_beatmap(beatmap_md5, **kwargs):
-    return MapData.from_beatmap(lib.lookup_by_md5(beatmap_md5),**kwargs)
+    """
+    Returns MapData for a map with mods applied, from the map store if it
+    contains the map, otherwise by parsing it
+    """
+    map_data = _from_store(beatmap_md5, **kwargs)
+    if map_data is not None:
+        return map_data
+    return parse_beatmap(beatmap_md5, **kwargs)
+
+def load_beatmap(beatmap_md5, **kwargs):
+    """
+    Like get_beatmap, but without keeping the map in memory or pickling it,
+    for reading each of a large number of maps once
+    """
+    map_data = _from_store(beatmap_md5, **kwargs)
+    if map_data is not None:
+        return map_data
+    return _parse_beatmap(beatmap_md5, **kwargs)
 
 def beatmap_from_replay(replay):
     return get_beatmap(
         replay.beatmap_md5,
         dt=replay.dt, hd=replay.hd, hr=replay.hr, ez=replay.ez, ht=replay.ht
     )
+
+
+def map_store_entry(beatmap_md5):
+    """
+    Parse a map into a map store entry, or return None if it can't be found
+    """
+    try:
+        osu_file = read_osu_file(beatmap_md5)
+        if osu_file is not None:
+            try:
+                return _osu_file_store_entry(beatmap_md5, osu_file)
+            except Exception:
+                pass
+        return _slider_store_entry(beatmap_md5, get_library().lookup_by_md5(beatmap_md5))
+    except KeyError:
+        return None
+    except Exception:
+        logging.exception("error parsing beatmap %s", beatmap_md5)
+        return None
+
+def _osu_file_store_entry(beatmap_md5, osu_file):
+    times, positions = osu_file.hit_objects()
+    _, hr_positions = osu_file.hit_objects(hard_rock=True)
+    return (
+        beatmap_md5,
+        osu_file.beatmap_id if osu_file.beatmap_id is not None else -1,
+        osu_file.display_name,
+        (osu_file.cs(), osu_file.cs(hard_rock=True), osu_file.cs(easy=True)),
+        (osu_file.od(), osu_file.od(hard_rock=True), osu_file.od(easy=True)),
+        np.column_stack((times / 10**6 * 1e3, positions, hr_positions))
+    )
+
+def _slider_store_entry(beatmap_md5, beatmap):
+    """
+    slider resolves stacking in place, so each variant is stacked on a fresh
+    copy of the map to avoid depending on which variant was computed first.
+    """
+    columns = []
+    for hr in (False, True):
+        hit_objects = copy.deepcopy(beatmap).hit_objects(spinners=False, hard_rock=hr)
+        if not columns:
+            columns.append([h.time.total_seconds()*1e3 for h in hit_objects])
+        columns.append([h.position.x for h in hit_objects])
+        columns.append([h.position.y for h in hit_objects])
+
+    return (
+        beatmap_md5,
+        beatmap.beatmap_id if beatmap.beatmap_id is not None else -1,
+        beatmap.display_name,
+        (beatmap.cs(), beatmap.cs(hard_rock=True), beatmap.cs(easy=True)),
+        (beatmap.od(), beatmap.od(hard_rock=True), beatmap.od(easy=True)),
+        np.array(columns, dtype="<f8").T.reshape(-1, map_store.HIT_OBJECT_COLUMNS)
+    )
+
+def pack_map_store(beatmap_md5s, workers=1):
+    """
+    Build the map store from a list of map md5s, replacing any existing store.
+    Returns the number of maps stored.
+    """
+    beatmap_md5s = sorted(set(beatmap_md5s))
+
+    def entries(results):
+        for i, entry in enumerate(results):
+            print(f"\rPacking maps: {i+1}/{len(beatmap_md5s)}", end="")
+            if entry is not None:
+                yield entry
+        print()
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            return map_store.write_store(entries(executor.map(map_store_entry, beatmap_md5s, chunksize=100)), MAP_DATA_VERSION)
+    return map_store.write_store(entries(map(map_store_entry, beatmap_md5s)), MAP_DATA_VERSION)
@@ -6,5 +6,20 @@ REPLAY_PATH = os.path.join(DATA_PATH, "replays")
 REPLAY_FEATURE_PATH = os.path.join(DATA_PATH, "replay_features")
 OSU_MAP_PATH = "../osu_files/"
 pkl_map_path = os.path.join(DATA_PATH, "map_cache")
+MAP_STORE_PATH = os.path.join(DATA_PATH, "map_store")
+TRAINING_CACHE_PATH = os.path.join(DATA_PATH, "training_cache")
+DIFFICULTY_CACHE_PATH = os.path.join(DATA_PATH, "difficulty_cache")
+
+# least recently used maps are removed from the difficulty cache once it grows
+# beyond this many bytes
+DIFFICULTY_CACHE_SIZE = 1 << 30
 
 REPLAYS_PER_BATCH = 200
+
+# use sqlite's write-ahead log, allowing reads while replays are being imported
+DB_WAL_MODE = False
+
+# only match clicks to hit objects within the hit window for a 50, rather than
+# the nearest hit object at any distance. Changes extracted features, so run
+# extract-replay-features --force after changing it
+MATCH_HIT_WINDOW = False
@@ -1,10 +1,31 @@
+import hashlib
+import os
+import shutil
+import time
 from enum import IntEnum
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import tensorflow as tf
-from .beatmap import beatmap_from_replay
-from . import db, frame
+import numba
+import peewee as pw
+from .beatmap import beatmap_from_replay, MAP_DATA_VERSION
+from .replay_features import FEATURE_VERSION, PACKED_FEATURE_VERSION
+from .frame_store import FRAME_FORMAT_VERSION
+from . import config, db, frame, metrics
+from .util import ordered_map
 
+# increment when difficulty_estimate, note_features, the filtering in
+# user_batch_dataset or the replays in each batch change, to invalidate the
+# training cache and batch skills
+DIFFICULTY_ESTIMATE_VERSION = 2
+
+# increment when the layout of training shards changes
+TRAINING_SHARD_VERSION = 2
+
+# the model sees each note along with this many notes either side of it
+CONTEXT_NOTES = 2
+WINDOW_SIZE = 2 * CONTEXT_NOTES + 1
 
 
 class AugmentedBeatmapColumns(IntEnum):
@@ -32,7 +53,80 @@ def linear_fit(x, y):
 
     return m, c
 
-def augment_beatmap_data(map_data):
+@numba.njit(cache=True, parallel=True)
+def _linear_fits(x, y, offsets):
+    n_segments = offsets.shape[0] - 1
+    m = np.full(n_segments, np.nan)
+    c = np.full(n_segments, np.nan)
+    for i in numba.prange(n_segments):
+        segment_x = x[offsets[i]:offsets[i+1]]
+        segment_y = y[offsets[i]:offsets[i+1]]
+        n = segment_y.shape[0]
+        # discard 5% either side
+        lb = int(n*0.05)
+        ub = int(n*0.95)
+        if ub - lb < 2:
+            continue
+        lo = np.partition(segment_y, lb)[lb]
+        hi = np.partition(segment_y, ub-1)[ub-1]
+        below_lo = 0
+        below_hi = 0
+        for v in segment_y:
+            below_lo += v < lo
+            below_hi += v < hi
+        # ties at the bounds are kept in index order, as a stable sort would
+        kept = np.empty(ub - lb, dtype=np.int64)
+        count = 0
+        ties_lo = 0
+        ties_hi = 0
+        for j in range(n):
+            v = segment_y[j]
+            if v == lo:
+                keep = lb <= below_lo + ties_lo < ub
+                ties_lo += 1
+            elif v == hi:
+                keep = below_hi + ties_hi < ub
+                ties_hi += 1
+            else:
+                keep = lo < v < hi
+            if keep:
+                kept[count] = j
+                count += 1
+
+        mean_x = 0.0
+        mean_y = 0.0
+        for j in kept:
+            mean_x += segment_x[j]
+            mean_y += segment_y[j]
+        mean_x /= kept.shape[0]
+        mean_y /= kept.shape[0]
+        sxy = 0.0
+        syy = 0.0
+        for j in kept:
+            dy = segment_y[j] - mean_y
+            sxy += dy * (segment_x[j] - mean_x)
+            syy += dy * dy
+        m[i] = sxy / syy
+        c[i] = mean_x - m[i] * mean_y
+    return m, c
+
+def linear_fits(x, y, offsets):
+    """
+    Vectorized linear_fit for each segment x[offsets[i]:offsets[i+1]],
+    y[offsets[i]:offsets[i+1]], fitting segments in parallel. Ties in y at the
+    trimmed bounds are broken by index, where linear_fit breaks them arbitrarily.
+
+    Returns arrays (m, c), which are nan for segments too small to fit
+    """
+    return _linear_fits(
+        np.asarray(x, dtype="d"), np.asarray(y, dtype="d"), np.asarray(offsets, dtype=np.int64))
+
+def note_features(map_data):
+    """
+    Features of each note after the first, as an (n, N_COLUMNS) array. The model
+    sees each note through a window of its neighbours' features, see
+    gather_windows.
+    """
     pos = map_data.hit_objects[:,frame.POS] * map_data.scale
     time = map_data.hit_objects[:,frame.TIME] * 1e-3
     delta_pos = np.diff(pos, axis=0)
@@ -51,38 +145,87 @@ def augment_beatmap_data(map_data):
     relative_delta_y = np.einsum("...i,...i", perpendicular_direction[:-1], delta_pos[1:])
 
 
-    data = np.zeros((delta_t.shape[0], 5,AugmentedBeatmapColumns.N_COLUMNS), dtype="float32")
-    data[:, 2, AugmentedBeatmapColumns.DELTA_T] = delta_t
-    data[:, 2, AugmentedBeatmapColumns.FREQUENCY] = freq
-    data[:, 2, AugmentedBeatmapColumns.DISTANCE] = distances
-    data[:, 2, AugmentedBeatmapColumns.VELOCITY] = distances * freq
-
-    data[1:, 2, AugmentedBeatmapColumns.DELTA_X] = relative_delta_x
-    data[1:, 2, AugmentedBeatmapColumns.DELTA_Y] =  relative_delta_y
+    data = np.zeros((delta_t.shape[0], AugmentedBeatmapColumns.N_COLUMNS), dtype="float32")
+    data[:, AugmentedBeatmapColumns.DELTA_T] = delta_t
+    data[:, AugmentedBeatmapColumns.FREQUENCY] = freq
+    data[:, AugmentedBeatmapColumns.DISTANCE] = distances
+    data[:, AugmentedBeatmapColumns.VELOCITY] = distances * freq
 
-    # add data for previous 2 and next 2
-    data[2:,0,:] = data[:-2,2,:]
-    data[1:,1,:] = data[:-1,2,:]
-    data[:-1,3,:] = data[1:,2,:]
-    data[:-2,4,:] = data[2:,2,:]
+    data[1:, AugmentedBeatmapColumns.DELTA_X] = relative_delta_x
+    data[1:, AugmentedBeatmapColumns.DELTA_Y] =  relative_delta_y
 
     return data
 
-def user_batch_dataset(user_id, batch):
+def pack_notes(map_notes):
+    """
+    Concatenate the note features of several maps, with CONTEXT_NOTES rows of
+    zeros before, between and after them, so that windows never include notes
+    from another map.
+
+    Returns (notes, starts), with map i's notes at notes[starts[i]:starts[i]+len(map_notes[i])]
+    """
+    lengths = np.array([len(n) for n in map_notes], dtype=np.int64) + CONTEXT_NOTES
+    starts = CONTEXT_NOTES + np.cumsum(lengths) - lengths
+    notes = np.zeros((CONTEXT_NOTES + np.sum(lengths), AugmentedBeatmapColumns.N_COLUMNS), dtype="float32")
+    for start, n in zip(starts, map_notes):
+        notes[start:start + len(n)] = n
+    return notes, starts
+
+def gather_windows(notes, note_index):
+    """
+    (len(note_index), WINDOW_SIZE, N_COLUMNS) windows of each indexed note and
+    its neighbours, from notes packed by pack_notes
+    """
+    return notes[np.asarray(note_index)[:, None] + np.arange(-CONTEXT_NOTES, CONTEXT_NOTES + 1)]
+
+def augment_beatmap_data(map_data):
+    """
+    Windows of each note of a map and its neighbours, as a read only view of
+    the map's note features rather than a copy for every window
+    """
+    padded = np.pad(note_features(map_data), ((CONTEXT_NOTES, CONTEXT_NOTES), (0, 0)))
+    return np.lib.stride_tricks.sliding_window_view(padded, (WINDOW_SIZE, AugmentedBeatmapColumns.N_COLUMNS))[:, 0]
 
+def user_batch_dataset(user_id, batch, skill=None):
+    """
+    Returns (notes, note_index, implied_difficulty) for a user batch, with an
+    example for each note_index into notes packed by pack_notes. Use
+    gather_windows for the model's input.
+
+    skill is the batch's (m, c) stored by fit_batch_skills, see user_batches,
+    or None to fit it from the batch.
+    """
+    with metrics.timer("user_batch_dataset"):
+        notes, note_index, implied_difficulty = _user_batch_dataset(user_id, batch, skill)
+    metrics.inc("user_batches")
+    metrics.inc("examples_built", len(implied_difficulty))
+    return notes, note_index, implied_difficulty
+
+def _user_batch_data(user_id, batch):
+    """
+    Returns (notes, note_index, hit_errors, estimated difficulty, first replay)
+    for the hit objects of a user batch, or None if none of its replays have
+    features. Each map is stored once in notes, however many replays of it
+    are in the batch.
+    """
     with db.db:
         replays = [r for r in db.replay_batch(user_id, batch)]
-    
-    hit_object_list = []
+
+    map_indexes = {}
+    map_notes = []
+    replay_maps = []
     hit_error_list = []
     for r in replays:
         try:
             replay_features = r.load_features()
 
-            hit_object_data = augment_beatmap_data(beatmap_from_replay(r))
+            key = (r.beatmap_md5, r.dt, r.hd, r.hr, r.ez, r.ht)
+            if key not in map_indexes:
+                map_notes.append(note_features(beatmap_from_replay(r)))
+                map_indexes[key] = len(map_notes) - 1
             hit_errors = np.linalg.norm(replay_features[1:,frame.POS], axis=-1) # skip first hit object - no delta_t or delta_pos
 
-            hit_object_list.append(hit_object_data)
+            replay_maps.append(map_indexes[key])
             hit_error_list.append(hit_errors)
         except FileNotFoundError:
             pass
@@ -90,25 +233,317 @@ def user_batch_dataset(user_id, batch):
 
 
     if hit_error_list:
-        hit_object_data = np.concatenate(hit_object_list)
+        notes, starts = pack_notes(map_notes)
+        note_index = np.concatenate([starts[i] + np.arange(len(map_notes[i])) for i in replay_maps]).astype(np.int32)
         hit_errors = np.concatenate(hit_error_list)
         # filter out large errors and nans
         # could be aiming somewhere else, misread, or missed clicking
         mask = hit_errors < 3
 
-        hit_object_data = hit_object_data[mask]
+        note_index = note_index[mask]
         hit_errors = hit_errors[mask]
 
-        hit_object_difficulty = difficulty_estimate(hit_object_data[:,2,AugmentedBeatmapColumns.DISTANCE],hit_object_data[:,2,AugmentedBeatmapColumns.DELTA_T])
-        #hit_object_difficulty = hit_object_data[:,2,AugmentedBeatmapColumns.FITTS_DIFFICULTY]
-        m, c = linear_fit(hit_errors, hit_object_difficulty)
+        hit_object_difficulty = difficulty_estimate(notes[note_index,AugmentedBeatmapColumns.DISTANCE],notes[note_index,AugmentedBeatmapColumns.DELTA_T])
+        #hit_object_difficulty = notes[note_index,AugmentedBeatmapColumns.FITTS_DIFFICULTY]
+        return notes, note_index, hit_errors, hit_object_difficulty, replays[0]
+    return None
+
+def _user_batch_dataset(user_id, batch, skill=None):
+    data = _user_batch_data(user_id, batch)
+    if data is not None:
+        notes, note_index, hit_errors, hit_object_difficulty, _ = data
+        if skill is not None:
+            m, c = skill
+        else:
+            m, c = linear_fit(hit_errors, hit_object_difficulty)
         implied_difficulty = (hit_errors-c)/m
-        return (hit_object_data, implied_difficulty)
-    return (tf.constant([],shape=(0,5,AugmentedBeatmapColumns.N_COLUMNS), dtype="float32"), tf.constant([], shape=(0,),dtype="float32"))
+        return (notes, note_index, implied_difficulty)
+    return (
+        np.zeros((0,AugmentedBeatmapColumns.N_COLUMNS), dtype="float32"),
+        np.zeros((0,), dtype=np.int32),
+        np.zeros((0,), dtype="float32"))
+
+
+def data_version():
+    """
+    The versions of everything training data is derived from
+    """
+    hit_window = "-hitwindow" if config.MATCH_HIT_WINDOW else ""
+    return (
+        f"features{FEATURE_VERSION}{hit_window}-frames{FRAME_FORMAT_VERSION}"
+        f"-maps{MAP_DATA_VERSION}-difficulty{DIFFICULTY_ESTIMATE_VERSION}")
+
+def training_cache_dir():
+    """
+    Directory for the training cache. Changing any of the versions the cache is
+    derived from moves to a new directory, invalidating the old cache.
+    """
+    return os.path.join(config.TRAINING_CACHE_PATH, f"{data_version()}-shards{TRAINING_SHARD_VERSION}")
+
+def _user_replay_counts(user_id=None):
+    """
+    Returns dicts of id, replay_count, last_replay (highest replay id) and
+    packed_features (replays whose features were extracted from packed frames)
+    for every user with replays, or just user_id
+    """
+    status = db.FeatureStatus
+    packed = pw.Case(None, [(status.version == PACKED_FEATURE_VERSION, 1)])
+    query = (db.User
+        .select(
+            db.User.id,
+            pw.fn.COUNT(db.Replay.id).alias("replay_count"),
+            pw.fn.MAX(db.Replay.id).alias("last_replay"),
+            pw.fn.COUNT(packed).alias("packed_features"))
+        .join(db.Replay)
+        .join(status, pw.JOIN.LEFT_OUTER)
+        .group_by(db.User.id))
+    if user_id is not None:
+        query = query.where(db.User.id == user_id)
+    with db.db:
+        return list(query.dicts())
+
+def _user_data_tag(user):
+    """
+    Identifies the replays a user's training data is derived from, so it's
+    invalidated by importing more replays or re-extracting features from
+    packed frames
+    """
+    return f"{user['replay_count']}.{user['last_replay']}.{user['packed_features']}"
+
+def batch_skill_key(user):
+    """
+    Identifies the data a user's batch skills are fitted from, like the
+    training cache paths
+    """
+    return f"{data_version()}-{_user_data_tag(user)}"
+
+def _skill_tag(skill):
+    """
+    Identifies the skill a training shard was built with, so shards are
+    rebuilt when fit_batch_skills stores a new fit
+    """
+    if skill is None:
+        return "fitted"
+    return "skill" + hashlib.sha1(np.array(skill, dtype="<f8").tobytes()).hexdigest()[:8]
+
+def user_batches():
+    """
+    Returns a list of (user_id, batch, cache_path, skill) for every user batch,
+    where skill is the (m, c) stored by fit_batch_skills, or None if the batch
+    hasn't been fitted or the data it was fitted from has changed.
+
+    Cache paths include the user's replay count, latest replay id and number
+    of replays with features from packed frames, so importing more replays for
+    a user or re-extracting their features invalidates their cached batches,
+    and the skill the batch was built with.
+    """
+    users = _user_replay_counts()
+    skills = stored_batch_skills(users)
+    return [
+        (
+            user["id"],
+            batch,
+            os.path.join(
+                training_cache_dir(),
+                f"{user['id']}-{_user_data_tag(user)}-{batch}"
+                f"-{_skill_tag(skills.get((user['id'], batch)))}.bin"
+            ),
+            skills.get((user["id"], batch)),
+        )
+        for user in users
+        for batch in range(user["replay_count"] // config.REPLAYS_PER_BATCH)
+    ]
+
+
+def stored_batch_skills(users):
+    """
+    Returns {(user_id, batch): (m, c)} stored by fit_batch_skills, for fits
+    whose data hasn't changed since, given _user_replay_counts() users
+    """
+    with db.db:
+        if not db.BatchSkill.table_exists():
+            return {}
+        skills = list(db.BatchSkill.select(
+            db.BatchSkill.user, db.BatchSkill.batch, db.BatchSkill.m, db.BatchSkill.c, db.BatchSkill.key))
+    keys = {user["id"]: batch_skill_key(user) for user in users}
+    return {
+        (skill.user_id, skill.batch): (skill.m, skill.c)
+        for skill in skills
+        if skill.key == keys.get(skill.user_id)
+    }
+
+def _batch_fit_data(user_batch):
+    user_id, batch = user_batch
+    data = _user_batch_data(user_id, batch)
+    if data is None:
+        return user_id, batch, None
+    _, _, hit_errors, hit_object_difficulty, first_replay = data
+    return user_id, batch, (hit_errors, hit_object_difficulty, first_replay.timestamp)
+
+def _save_batch_skills(fit_data, keys):
+    """
+    Fit and store the skills for a list of (user_id, batch, (hit_errors,
+    difficulty, timestamp)) with a single vectorized fit
+    """
+    offsets = np.zeros(len(fit_data) + 1, dtype=np.int64)
+    np.cumsum([len(hit_errors) for _, _, (hit_errors, _, _) in fit_data], out=offsets[1:])
+    with metrics.timer("linear_fits"):
+        m, c = linear_fits(
+            np.concatenate([hit_errors for _, _, (hit_errors, _, _) in fit_data]),
+            np.concatenate([difficulty for _, _, (_, difficulty, _) in fit_data]),
+            offsets)
+
+    rows = [
+        (user_id, batch, m[i], c[i], int(offsets[i+1] - offsets[i]), timestamp, keys[user_id])
+        for i, (user_id, batch, (_, _, timestamp)) in enumerate(fit_data)
+        if np.isfinite(m[i])
+    ]
+    skill = db.BatchSkill
+    fields = [skill.user, skill.batch, skill.m, skill.c, skill.hit_objects, skill.timestamp, skill.key]
+    with db.db:
+        # sqlite limits the number of variables in a statement
+        for i in range(0, len(rows), 100):
+            skill.insert_many(rows[i:i+100], fields=fields).on_conflict_replace().execute()
+    metrics.inc("batch_skills_fitted", len(rows))
+
+def fit_batch_skills(force=False, workers=1, batches_per_fit=256):
+    """
+    Fit the skill of every user batch and store it in the db, so training
+    doesn't refit it every time the batch is loaded.
+
+    Batches are loaded by worker processes, and fitted batches_per_fit at a
+    time. Fits which are up to date are skipped unless force is set.
+    """
+    with db.db:
+        db.db.create_tables([db.BatchSkill])
+        existing = {
+            (skill.user_id, skill.batch): skill.key
+            for skill in db.BatchSkill.select(db.BatchSkill.user, db.BatchSkill.batch, db.BatchSkill.key)
+        }
+
+    keys = {user["id"]: batch_skill_key(user) for user in _user_replay_counts()}
+    pending = [
+        (user_id, batch) for user_id, batch, _, _ in user_batches()
+        if force or existing.get((user_id, batch)) != keys[user_id]
+    ]
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers)
+        results = metrics.merged(
+            ordered_map(executor, partial(metrics.collecting, _batch_fit_data), pending, max_pending=2*workers))
+    else:
+        executor = None
+        results = map(_batch_fit_data, pending)
+
+    fit_data = []
+    try:
+        for i, (user_id, batch, data) in enumerate(results, 1):
+            if data is not None:
+                fit_data.append((user_id, batch, data))
+            if len(fit_data) >= batches_per_fit:
+                _save_batch_skills(fit_data, keys)
+                fit_data = []
+            print(f"\rLoaded user {user_id} batch {batch}. Progress: {i}/{len(pending)}", end="")
+        if fit_data:
+            _save_batch_skills(fit_data, keys)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print()
+
+def write_training_shard(path, notes, note_index, implied_difficulty):
+    """
+    Shards are the number of notes and examples as int32, then the notes as
+    float32, each example's note_index as int32 and the implied difficulties as
+    float32
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            for data in (
+                np.array([len(notes), len(note_index)], dtype="<i4"),
+                np.asarray(notes, dtype="<f4"),
+                np.asarray(note_index, dtype="<i4"),
+                np.asarray(implied_difficulty, dtype="<f4"),
+            ):
+                f.write(data.tobytes())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def training_shard_examples(path):
+    """
+    Number of examples in a training shard, from its header
+    """
+    return int(np.fromfile(path, dtype="<i4", count=2)[1])
+
+def read_training_shard(path):
+    data = np.fromfile(path, dtype="<i4")
+    note_count, example_count = data[:2]
+    notes_end = 2 + note_count * AugmentedBeatmapColumns.N_COLUMNS
+    notes = data[2:notes_end].view("<f4").reshape((note_count, AugmentedBeatmapColumns.N_COLUMNS))
+    note_index = data[notes_end:notes_end + example_count]
+    return notes, note_index, data[notes_end + example_count:].view("<f4")
+
+def _build_training_shard(user_batch):
+    user_id, batch, path, skill = user_batch
+    notes, note_index, implied_difficulty = user_batch_dataset(user_id, batch, skill)
+    with metrics.timer("write_training_shard"):
+        write_training_shard(path, notes, note_index, implied_difficulty)
+    return user_id, batch
+
+def build_training_cache(force=False, workers=1):
+    """
+    Write the training data for every user batch to disk, so that it doesn't
+    need to be recomputed every epoch
+    """
+    cache_dir = training_cache_dir()
+    if os.path.isdir(config.TRAINING_CACHE_PATH):
+        for entry in os.scandir(config.TRAINING_CACHE_PATH):
+            if entry.is_dir() and entry.path != cache_dir:
+                shutil.rmtree(entry.path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    batches = user_batches()
+    expected = {path for _, _, path, _ in batches}
+    for entry in os.scandir(cache_dir):
+        if entry.path not in expected:
+            os.remove(entry.path)
+
+    pending = [b for b in batches if force or not os.path.exists(b[2])]
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers)
+        results = metrics.merged(
+            ordered_map(executor, partial(metrics.collecting, _build_training_shard), pending, max_pending=2*workers))
+    else:
+        executor = None
+        results = map(_build_training_shard, pending)
+
+    try:
+        for i, (user_id, batch) in enumerate(results, 1):
+            print(f"\rBuilt training cache for user {user_id} batch {batch}. Progress: {i}/{len(pending)}", end="")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print()
+
+
+# tensorflow is only imported by the functions building tf.data pipelines, so
+# that preprocessing in worker processes doesn't need it
+
+def wrapped_user_batch_dataset(user_batch, skills):
+    """
+    skills is {(user_id, batch): skill} from user_batches
+    """
+    import tensorflow as tf
 
-def wrapped_user_batch_dataset(user_batch):
     def func(user_batch):
-        return user_batch_dataset(int(user_batch[0]), int(user_batch[1]))
+        user_id, batch = int(user_batch[0]), int(user_batch[1])
+        notes, note_index, implied_difficulty = user_batch_dataset(user_id, batch, skills.get((user_id, batch)))
+        return gather_windows(notes, note_index), implied_difficulty
 
     py_func = tf.py_function(
         func,
@@ -117,39 +552,125 @@ def wrapped_user_batch_dataset(user_batch):
     )
 
     return (
-        tf.ensure_shape(py_func[0], (None,5,AugmentedBeatmapColumns.N_COLUMNS)),
+        tf.ensure_shape(py_func[0], (None,WINDOW_SIZE,AugmentedBeatmapColumns.N_COLUMNS)),
         tf.ensure_shape(py_func[1], (None,))
     )
 
+def read_training_shard_op(path):
+    """
+    Equivalent of read_training_shard using only native tensorflow ops, so it
+    isn't serialized by the GIL
+    """
+    import tensorflow as tf
+    contents = tf.io.read_file(path)
+    ints = tf.io.decode_raw(contents, tf.int32, little_endian=True)
+    floats = tf.io.decode_raw(contents, tf.float32, little_endian=True)
+    note_count, example_count = ints[0], ints[1]
+    notes_end = 2 + note_count * AugmentedBeatmapColumns.N_COLUMNS
+    notes = tf.reshape(floats[2:notes_end], (-1, AugmentedBeatmapColumns.N_COLUMNS))
+    return notes, ints[notes_end:notes_end + example_count], floats[notes_end + example_count:]
+
+def shard_dataset(path, chunk_size=256):
+    """
+    Dataset of (window, implied difficulty) examples from a training shard, in
+    a random order. Windows are gathered from the shard's notes a chunk at a
+    time, so a shard is only held in memory in its compact form.
+    """
+    import tensorflow as tf
+    notes, note_index, implied_difficulty = read_training_shard_op(path)
+    # shuffling the whole shard is free before the windows are gathered
+    order = tf.random.shuffle(tf.range(tf.shape(note_index)[0]))
+    offsets = tf.range(-CONTEXT_NOTES, CONTEXT_NOTES + 1)
+    return (tf.data.Dataset.from_tensor_slices((tf.gather(note_index, order), tf.gather(implied_difficulty, order)))
+        .batch(chunk_size)
+        .map(lambda index, implied: (tf.gather(notes, index[:, None] + offsets), implied))
+        .unbatch())
+
+
+def make_dataset(user_batches, use_cache=True):
+    """
+    Dataset of (windows, implied difficulty) examples for a list of
+    user_batches() tuples, read from the training cache where it has them
+    """
+    import tensorflow as tf
+    cached = [path for _, _, path, _ in user_batches if use_cache and os.path.exists(path)]
+    live = [[user_id, batch] for user_id, batch, path, _ in user_batches if not (use_cache and os.path.exists(path))]
+    skills = {(user_id, batch): skill for user_id, batch, _, skill in user_batches}
+
+    datasets = []
+    if cached:
+        datasets.append(
+            tf.data.Dataset.from_tensor_slices(cached).shuffle(len(cached)).interleave(
+                shard_dataset,
+                cycle_length=6,
+                deterministic=False,
+                num_parallel_calls=tf.data.AUTOTUNE
+            ))
+    if live or not cached:
+        if cached:
+            print(f"{len(live)} user batches aren't in the training cache, run build-training-cache to speed up training")
+        datasets.append(
+            tf.data.Dataset.from_tensor_slices(tf.constant(live, shape=(len(live), 2), dtype=tf.int64)).shuffle(max(len(live), 1)).interleave(
+                lambda x: tf.data.Dataset.from_tensor_slices(wrapped_user_batch_dataset(x, skills)),
+                cycle_length=6,
+                deterministic=False,
+                num_parallel_calls=tf.data.AUTOTUNE
+            ))
+
+    if len(datasets) == 1:
+        return datasets[0]
+    return tf.data.Dataset.sample_from_datasets(datasets, weights=[len(cached), len(live)])
+
+
+def training_user_batches(validation=False):
+    """
+    User batches for training, or every 10th batch held out for validation
+    """
+    return [b for b in user_batches() if (b[1] % 10 == 0) == validation]
 
-def _make_dataset(user_batches):
-    tf.random.shuffle(user_batches)
+def split_user_batches(user_batches, n):
+    """
+    Split cached user batches into n lists with similar numbers of examples,
+    e.g. one for each training worker.
 
-    dataset =  tf.data.Dataset.from_tensor_slices(user_batches)
-            
-    return dataset.interleave(
-        lambda x: tf.data.Dataset.from_tensor_slices(wrapped_user_batch_dataset(x)),
-        cycle_length=6,
-        deterministic=False,
-        num_parallel_calls=tf.data.AUTOTUNE
-        )
+    Returns (lists of user batches, number of examples in each list)
+    """
+    splits = [[] for _ in range(n)]
+    examples = [0] * n
+    sized = [(training_shard_examples(user_batch[2]), user_batch) for user_batch in user_batches]
+    for size, user_batch in sorted(sized, key=lambda s: s[0], reverse=True):
+        i = examples.index(min(examples))
+        splits[i].append(user_batch)
+        examples[i] += size
+    return splits, examples
+
+def make_training_dataset(use_cache=True):
+    """
+    difficulty_func: a function to assess difficulty of hit objects - used to assess skill of user
+    """
 
+    return make_dataset(training_user_batches(), use_cache)
 
-def make_training_dataset():
+def make_validation_dataset(use_cache=True):
     """
     difficulty_func: a function to assess difficulty of hit objects - used to assess skill of user
     """
+    return make_dataset(training_user_batches(validation=True), use_cache)
 
-    with db.db:
-        user_batches = [ [user.id, batch] for user in db.User.select() for batch in range(user.batch_count()) if batch % 10 != 0]
-
-    return _make_dataset(user_batches)
 
-def make_validation_dataset():
+def measure_throughput(dataset, max_examples=1000000, batch_size=1024):
     """
-    difficulty_func: a function to assess difficulty of hit objects - used to assess skill of user
+    Returns (examples, examples/sec) when iterating through a dataset
     """
-    with db.db:
-        user_batches = [ [user.id, batch] for user in db.User.select() for batch in range(user.batch_count()) if batch % 10 == 0]
-    
-    return _make_dataset(user_batches)
+    examples = 0
+    start = time.perf_counter()
+    batch_start = start
+    for hit_object_data, _ in dataset.batch(batch_size).prefetch(10):
+        now = time.perf_counter()
+        metrics.observe("input_batch", now - batch_start)
+        batch_start = now
+        metrics.inc("examples_read", hit_object_data.shape[0])
+        examples += hit_object_data.shape[0]
+        if examples >= max_examples:
+            break
+    return examples, examples / (time.perf_counter() - start)
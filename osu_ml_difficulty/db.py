@@ -4,7 +4,7 @@ import numpy as np
 import peewee as pw
 from slider.mod import Mod
 
-from  osu_ml_difficulty import config
+from  osu_ml_difficulty import config, feature_store, frame_store
 
 
 
@@ -12,7 +12,7 @@ from  osu_ml_difficulty import config
 db = pw.SqliteDatabase(
     os.path.join(config.DATA_PATH,'replays.db'),
     pragmas={
-        #'journal_mode': 'wal',
+        'journal_mode': 'wal' if config.DB_WAL_MODE else 'delete',
         'cache_size': -1 * 64000,  # 64MB
         'foreign_keys': 1,
         'ignore_check_constraints': 0,
@@ -38,7 +38,8 @@ class User(BaseModel):
         return replay_batch(self.id, i, batch_size)
 
 def replay_batch(user_id, i, batch_size=config.REPLAYS_PER_BATCH):
-    return Replay.select().where(Replay.user == user_id).order_by(Replay.timestamp).paginate(i, batch_size)
+    # batches count from 0, but peewee's pages count from 1
+    return Replay.select().where(Replay.user == user_id).order_by(Replay.timestamp).paginate(i + 1, batch_size)
 
 
 class Replay(BaseModel):
@@ -65,17 +66,80 @@ class Replay(BaseModel):
     max_combo = pw.IntegerField()
     score = pw.FloatField()
 
+    def frames_path(self):
+        return os.path.join(config.REPLAY_PATH, self.filename)
+
+    def has_packed_frames(self):
+        return frame_store.has_packed_frames(self.user_id, self.id)
+
     def load_frames(self):
-        return np.load(os.path.join(config.REPLAY_PATH,self.filename))
+        store = frame_store.get_store(self.user_id)
+        if store is not None and self.id in store:
+            return store.load(self.id)
+        return np.load(self.frames_path())
 
     def feature_path(self):
         return os.path.join(config.REPLAY_FEATURE_PATH, self.filename)
 
-    def load_features(self):
-        return np.load(self.feature_path())
+    def has_features(self):
+        store = feature_store.get_store(self.user_id)
+        return (store is not None and self.id in store) or os.path.exists(self.feature_path())
+
+    def load_features(self, mmap_mode=None):
+        store = feature_store.get_store(self.user_id)
+        if store is not None and self.id in store:
+            return store.load(self.id)
+        return np.load(self.feature_path(), mmap_mode=mmap_mode)
 
 Replay.add_index(Replay.user, Replay.timestamp)
 
+
+class FeatureStatus(BaseModel):
+    """
+    Outcome of the last feature extraction for a replay, so that incremental
+    runs can select new or stale replays without checking for feature files
+    """
+    OK = "ok"
+    NO_CLICKS = "no_clicks"
+    MISSING_BEATMAP = "missing_beatmap"
+    ERROR = "error"
+    FAILED = (MISSING_BEATMAP, ERROR)
+
+    replay = pw.ForeignKeyField(Replay, primary_key=True, backref="feature_status", on_delete="CASCADE")
+    # replay_features.FEATURE_VERSION, or PACKED_FEATURE_VERSION for replays
+    # whose frames were packed, which produced the status. OUTDATED_VERSION
+    # once the replay's frames are repacked
+    version = pw.IntegerField()
+    status = pw.CharField(max_length=16)
+    # exception class name for errors
+    error = pw.CharField(null=True)
+
+FeatureStatus.add_index(FeatureStatus.version, FeatureStatus.status)
+
+
+class BatchSkill(BaseModel):
+    """
+    Skill of a user over a batch of replays, fitted by dataset.fit_batch_skills
+    as hit_error = m * estimated_difficulty + c
+    """
+    user = pw.ForeignKeyField(User, backref="batch_skills", on_delete="CASCADE")
+    batch = pw.IntegerField()
+    m = pw.FloatField()
+    c = pw.FloatField()
+    # number of hit objects in the fit
+    hit_objects = pw.IntegerField()
+    # of the first replay in the batch
+    timestamp = pw.TimestampField(resolution=1e6, utc=True)
+    # dataset.batch_skill_key of the data the fit was derived from
+    key = pw.CharField()
+
+    class Meta:
+        primary_key = pw.CompositeKey("user", "batch")
+
+
+def replay_beatmap_md5s():
+    return [r.beatmap_md5 for r in Replay.select(Replay.beatmap_md5).distinct()]
+
 def init_db():
     with db:
-        db.create_tables([User, Replay])
+        db.create_tables([User, Replay, FeatureStatus, BatchSkill])
@@ -0,0 +1,135 @@
+"""
+On disk cache of evaluated maps.
+
+Each entry holds the note difficulties and required skill of a map with a set
+of mods, as evaluated by one model. Entries live in a directory per model,
+named by a hash of its weights, so a retrained model never reads another
+model's results. The total size of the cache is bounded by deleting the least
+recently used entries, whichever model they belong to.
+"""
+
+import glob
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from . import config, metrics
+from .beatmap import MAP_DATA_VERSION
+
+
+def model_hash(model):
+    """
+    Hash of a model's weights, either a keras model or a NumpyModel
+    """
+    h = hashlib.sha256()
+    for weights in model.get_weights():
+        weights = np.ascontiguousarray(weights)
+        h.update(str((weights.dtype.str, weights.shape)).encode())
+        h.update(weights.tobytes())
+    return h.hexdigest()[:16]
+
+
+class DifficultyCache:
+    """
+    Evaluated maps for the model with the given hash, see model_hash()
+    """
+    def __init__(self, model_hash, path=None, max_bytes=None):
+        self.path = config.DIFFICULTY_CACHE_PATH if path is None else path
+        self.directory = os.path.join(self.path, f"{model_hash}-maps{MAP_DATA_VERSION}")
+        self.max_bytes = config.DIFFICULTY_CACHE_SIZE if max_bytes is None else max_bytes
+        # total size of the cache, counted when first needed
+        self.size = None
+
+    def entry_path(self, beatmap_md5, mods):
+        mods = "".join(sorted(set(mods)))
+        return os.path.join(self.directory, f"{beatmap_md5}[{mods}].npz")
+
+    def get(self, beatmap_md5, mods):
+        """
+        Returns a dict of the entry's note_difficulties, required_skill, name and
+        ppv2_aim (nan if it wasn't stored), or None if the map isn't cached
+        """
+        path = self.entry_path(beatmap_md5, mods)
+        try:
+            with np.load(path) as entry:
+                result = {
+                    "note_difficulties": entry["note_difficulties"],
+                    "required_skill": float(entry["required_skill"]),
+                    "name": str(entry["name"]),
+                    "ppv2_aim": float(entry["ppv2_aim"]),
+                }
+            # the modification time orders entries for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # missing, or a corrupt entry which will be overwritten
+            metrics.inc("difficulty_cache_misses")
+            return None
+        metrics.inc("difficulty_cache_hits")
+        return result
+
+    def put(self, beatmap_md5, mods, note_difficulties, required_skill, name="", ppv2_aim=np.nan):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.entry_path(beatmap_md5, mods)
+        # write then rename, so other processes never read a partial entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(
+                f,
+                note_difficulties=np.asarray(note_difficulties, dtype="float32"),
+                required_skill=np.float64(required_skill),
+                name=np.array(name),
+                ppv2_aim=np.float64(ppv2_aim),
+            )
+        size = os.path.getsize(temp_path)
+        try:
+            # an overwritten entry no longer counts towards the total
+            size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, path)
+
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        return glob.glob(os.path.join(self.path, "*", "*.npz"))
+
+    def total_size(self):
+        size = 0
+        for path in self.entries():
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def evict(self, fraction=0.9):
+        """
+        Delete the least recently used entries until the cache is below
+        fraction of its maximum size, so that eviction doesn't run on every put
+        """
+        entries = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes * fraction:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            metrics.inc("difficulty_cache_evictions")
+        self.size = size
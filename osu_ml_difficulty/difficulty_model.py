@@ -1,3 +1,12 @@
+import json
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import socket
+import time
+
 import tensorflow as tf
 
 
@@ -14,7 +23,7 @@ if gpus:
 
 
 def create_model():
-    inputs = keras.Input(shape=(5,dataset.AugmentedBeatmapColumns.N_COLUMNS,))
+    inputs = keras.Input(shape=(dataset.WINDOW_SIZE,dataset.AugmentedBeatmapColumns.N_COLUMNS,))
     x = layers.Flatten()(inputs)
     x = layers.BatchNormalization()(x)
     x = layers.Dense(64, activation="relu")(x)
@@ -27,12 +36,57 @@ def create_model():
     return model
 
 
-def fit(filename="model.keras", max_batch_count=None):
-    m = create_model()
+def checkpoint_dir(filename):
+    """
+    Directory of per epoch checkpoints while training a model to filename,
+    removed once training finishes
+    """
+    return os.path.splitext(filename)[0] + "-checkpoints"
+
+def latest_checkpoint(directory):
+    """
+    Returns (epoch, path) of the last checkpoint in directory, or (0, None) if
+    there isn't one
+    """
+    epochs = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            match = re.fullmatch(r"epoch-(\d+)\.keras", name)
+            if match:
+                epochs.append(int(match.group(1)))
+    if not epochs:
+        return 0, None
+    return max(epochs), os.path.join(directory, f"epoch-{max(epochs)}.keras")
+
+def _resume_or_create(directory):
+    """
+    Returns (epochs completed, model) from the last checkpoint, or a new model
+    """
+    epoch, path = latest_checkpoint(directory)
+    if path is None:
+        return 0, create_model()
+    print(f"Resuming from {path}")
+    return epoch, keras.models.load_model(path)
+
+
+def fit(filename="model.keras", max_batch_count=None, epochs=1, workers=1, batch_size=1024):
+    """
+    Train a model and save it to filename.
+
+    The model is checkpointed after every epoch, so an interrupted run resumes
+    from the last completed epoch when run again. With more than one worker,
+    training is data parallel across worker processes, see fit_distributed.
+    """
+    if workers > 1:
+        return fit_distributed(filename, max_batch_count, epochs, workers, batch_size)
+
+    checkpoints = checkpoint_dir(filename)
+    os.makedirs(checkpoints, exist_ok=True)
+    initial_epoch, m = _resume_or_create(checkpoints)
     m.summary()
-    training_data = dataset.make_training_dataset().shuffle(10000).batch(1024).prefetch(10)
-    validation_data = dataset.make_validation_dataset().batch(1024).prefetch(10)
-    
+    training_data = dataset.make_training_dataset().shuffle(10000).batch(batch_size).prefetch(10)
+    validation_data = dataset.make_validation_dataset().batch(batch_size).prefetch(10)
+
     if max_batch_count:
         training_data = training_data.take(max_batch_count)
         validation_data = validation_data.take(max_batch_count)
@@ -40,16 +94,170 @@ def fit(filename="model.keras", max_batch_count=None):
     history = m.fit(
         training_data,
         validation_data=validation_data,
-        epochs=1,
+        epochs=epochs,
+        initial_epoch=initial_epoch,
         callbacks=[
-            keras.callbacks.TensorBoard(update_freq=1000, histogram_freq=1000, profile_batch=(2,4))
+            keras.callbacks.TensorBoard(update_freq=1000, histogram_freq=1000, profile_batch=(2,4)),
+            keras.callbacks.ModelCheckpoint(os.path.join(checkpoints, "epoch-{epoch}.keras")),
         ])
     print(history.history)
     m.save(filename)
+    shutil.rmtree(checkpoints, ignore_errors=True)
+
+
+def fit_distributed(filename="model.keras", max_batch_count=None, epochs=1, workers=2, batch_size=1024):
+    """
+    Train a model with data parallelism across worker processes on this
+    machine, using MultiWorkerMirroredStrategy.
+
+    Each worker reads its share of the training cache, which is built first,
+    and gradients are summed across workers every step, so batch_size is the
+    total over all workers. If a worker fails, the others are stopped, and
+    running again resumes from the last completed epoch.
+    """
+    dataset.build_training_cache(workers=workers)
+
+    # tensorflow can't be used in a forked child once it has been used
+    context = multiprocessing.get_context("spawn")
+    # each worker reserves its own port and reports it, then is sent the
+    # address of every worker
+    ports = context.Queue()
+    cluster_queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(
+            target=_train_worker,
+            args=(index, ports, cluster_queues[index], filename, max_batch_count, epochs, batch_size),
+            name=f"train-worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def check_workers():
+        for index, process in enumerate(processes):
+            if process.exitcode not in (None, 0):
+                raise RuntimeError(
+                    f"Training worker {index} failed with exit code {process.exitcode}. "
+                    "Run again to resume from the last checkpoint")
+
+    try:
+        addresses = [None] * workers
+        while None in addresses:
+            check_workers()
+            try:
+                index, port = ports.get(timeout=1)
+            except queue.Empty:
+                continue
+            addresses[index] = f"localhost:{port}"
+        for cluster_queue in cluster_queues:
+            cluster_queue.put(addresses)
+
+        while not all(process.exitcode == 0 for process in processes):
+            check_workers()
+            time.sleep(1)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def _train_worker(index, ports, cluster_queue, filename, max_batch_count, epochs, batch_size):
+    # hold the port until tensorflow's server binds it, so that no other
+    # process can take it while the other workers start. The server can't
+    # share the port, so it's released just before the strategy starts it
+    reserved = socket.socket()
+    reserved.bind(("localhost", 0))
+    ports.put((index, reserved.getsockname()[1]))
+    addresses = cluster_queue.get()
+
+    os.environ["TF_CONFIG"] = json.dumps({
+        "cluster": {"worker": addresses},
+        "task": {"type": "worker", "index": index},
+    })
+    # share the cores between workers rather than each using all of them
+    threads = max(1, (os.cpu_count() or 1) // len(addresses))
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    reserved.close()
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    chief = index == 0
+    checkpoints = checkpoint_dir(filename)
+    if chief:
+        os.makedirs(checkpoints, exist_ok=True)
+
+    training_splits, training_examples = dataset.split_user_batches(dataset.training_user_batches(), len(addresses))
+    validation_splits, _ = dataset.split_user_batches(dataset.training_user_batches(validation=True), len(addresses))
+    # every worker must run the same number of steps, so epochs are sized by
+    # the smallest share
+    worker_batch_size = batch_size // len(addresses)
+    steps = min(training_examples) // worker_batch_size
+    if max_batch_count:
+        steps = min(steps, max_batch_count)
+
+    def training_input(context):
+        return (dataset.make_dataset(training_splits[context.input_pipeline_id])
+            .repeat()
+            .shuffle(10000)
+            .batch(context.get_per_replica_batch_size(batch_size))
+            .prefetch(10))
+    iterator = iter(strategy.distribute_datasets_from_function(training_input))
+
+    validation_data = dataset.make_dataset(validation_splits[index]).batch(worker_batch_size).prefetch(10)
+    if max_batch_count:
+        validation_data = validation_data.take(max_batch_count)
+
+    with strategy.scope():
+        initial_epoch, model = _resume_or_create(checkpoints)
+        if not model.optimizer.built:
+            model.optimizer.build(model.trainable_variables)
+    if chief:
+        model.summary()
+
+    @tf.function
+    def train_step(iterator):
+        def step(hit_object_data, implied_difficulty):
+            with tf.GradientTape() as tape:
+                errors = tf.abs(implied_difficulty - tf.squeeze(model(hit_object_data, training=True), -1))
+                loss = tf.nn.compute_average_loss(errors, global_batch_size=batch_size)
+            gradients = tape.gradient(loss, model.trainable_variables)
+            # the optimizer sums gradients across workers
+            model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, strategy.run(step, args=next(iterator)), axis=None)
+
+    @tf.function
+    def validation_step(hit_object_data, implied_difficulty):
+        errors = tf.abs(implied_difficulty - tf.squeeze(model(hit_object_data, training=False), -1))
+        return tf.stack([tf.reduce_sum(errors), tf.cast(tf.size(errors), tf.float32)])
+
+    @tf.function
+    def all_workers_sum(value):
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, strategy.run(tf.identity, args=(value,)), axis=None)
+
+    for epoch in range(initial_epoch, epochs):
+        start = time.perf_counter()
+        loss = tf.constant(0.0)
+        for i in range(1, steps + 1):
+            loss += train_step(iterator)
+            if chief and (i % 100 == 0 or i == steps):
+                print(f"\rEpoch {epoch + 1}/{epochs}: step {i}/{steps}, loss {float(loss) / i:.4f}", end="")
+
+        validation = tf.zeros(2)
+        for hit_object_data, implied_difficulty in validation_data:
+            validation += validation_step(hit_object_data, implied_difficulty)
+        validation = all_workers_sum(validation)
+
+        if chief:
+            print(f", val_loss {float(validation[0] / validation[1]):.4f}, {time.perf_counter() - start:.0f}s")
+            model.save(os.path.join(checkpoints, f"epoch-{epoch + 1}.keras"))
+
+    if chief:
+        model.save(filename)
+        shutil.rmtree(checkpoints, ignore_errors=True)
 
 
 def load_model(path):
     return keras.models.load_model(path)
 
 if __name__=="__main__":
-    fit()
\ No newline at end of file
+    fit()
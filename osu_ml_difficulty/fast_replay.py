@@ -1,14 +1,14 @@
 from enum import IntFlag, IntEnum
-import io
+import datetime
+import struct
 
 import lzma
+import numba
 import numpy as np
-import pandas as pd
 
 from slider.replay import Replay
 from slider.game_mode import GameMode
 from slider.mod import Mod
-from slider.utils import consume_byte, consume_short, consume_int, consume_string, consume_datetime
 
 from . import frame
 
@@ -24,22 +24,171 @@ class Buttons(IntFlag):
     K2 = 10
 
 
-def _consume_actions(buffer):
-    compressed_byte_count = consume_int(buffer)
-    compressed_data = buffer[:compressed_byte_count]
-    del buffer[:compressed_byte_count]
+_WINDOWS_EPOCH = datetime.datetime(1, 1, 1)
+
+
+class _Reader:
+    """Reads little endian values from a memoryview, tracking the offset rather
+    than copying or deleting from the buffer
+    """
+    __slots__ = ("view", "offset")
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def _unpack(self, fmt):
+        result, = struct.unpack_from(fmt, self.view, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return result
+
+    def byte(self):
+        return self._unpack("<B")
+
+    def short(self):
+        return self._unpack("<H")
+
+    def int(self):
+        return self._unpack("<I")
+
+    def long(self):
+        return self._unpack("<Q")
+
+    def uleb128(self):
+        result = 0
+        shift = 0
+        while True:
+            byte = self.byte()
+            result |= (byte & 0x7F) << shift
+            if (byte & 0x80) == 0:
+                return result
+            shift += 7
+
+    def bytes(self, count):
+        result = self.view[self.offset:self.offset + count]
+        if len(result) != count:
+            raise ValueError("unexpected end of replay data")
+        self.offset += count
+        return result
+
+    def string(self):
+        mode = self.byte()
+        if mode == 0:
+            return None
+        if mode != 0x0B:
+            raise ValueError(
+                f"unknown string start byte: {hex(mode)}, expected 0 or 0x0b",
+            )
+        return str(self.bytes(self.uleb128()), "utf-8")
+
+    def datetime(self):
+        return _WINDOWS_EPOCH + datetime.timedelta(microseconds=self.long() / 10)
+
+
+_POWERS_OF_10 = 10.0 ** np.arange(23)
+
+
+@numba.njit(cache=True)
+def _parse_number(data, i):
+    """
+    Parse an int or float starting at data[i]. Returns the value and the index
+    of the character after it.
+    """
+    n = data.shape[0]
+    negative = data[i] == 45 # '-'
+    if data[i] == 45 or data[i] == 43: # '-', '+'
+        i += 1
+
+    mantissa = 0
+    exponent = 0
+    while i < n and 48 <= data[i] <= 57:
+        mantissa = mantissa * 10 + (data[i] - 48)
+        i += 1
+    if i < n and data[i] == 46: # '.'
+        i += 1
+        while i < n and 48 <= data[i] <= 57:
+            mantissa = mantissa * 10 + (data[i] - 48)
+            exponent -= 1
+            i += 1
+    if i < n and (data[i] == 69 or data[i] == 101): # 'E', 'e'
+        i += 1
+        exponent_negative = data[i] == 45 if i < n else False
+        if i < n and (data[i] == 45 or data[i] == 43):
+            i += 1
+        explicit_exponent = 0
+        while i < n and 48 <= data[i] <= 57:
+            explicit_exponent = explicit_exponent * 10 + (data[i] - 48)
+            i += 1
+        exponent += -explicit_exponent if exponent_negative else explicit_exponent
+
+    # dividing by an exact power of 10 gives a correctly rounded result
+    if -22 <= exponent < 0:
+        value = mantissa / _POWERS_OF_10[-exponent]
+    elif 0 <= exponent <= 22:
+        value = mantissa * _POWERS_OF_10[exponent]
+    else:
+        value = mantissa * 10.0**exponent
+    return (-value if negative else value), i
+
+
+@numba.njit(cache=True)
+def _is_number_start(c):
+    return 48 <= c <= 57 or c == 45 or c == 43 or c == 46 # digit, '-', '+', '.'
+
+
+@numba.njit(cache=True)
+def _tokenize_actions(data):
+    """
+    Parse ``w|x|y|z,`` action text (as uint8) into an (n, 4) float32 array
+    """
+    n_rows = 0
+    row_has_data = False
+    for c in data:
+        if c == 44: # ','
+            if row_has_data:
+                n_rows += 1
+            row_has_data = False
+        elif _is_number_start(c):
+            row_has_data = True
+    if row_has_data:
+        n_rows += 1
+
+    result = np.full((n_rows, 4), np.nan, dtype=np.float32)
+    row = 0
+    column = 0
+    i = 0
+    while i < data.shape[0]:
+        c = data[i]
+        if _is_number_start(c):
+            value, i = _parse_number(data, i)
+            if column < 4:
+                result[row, column] = value
+            column += 1
+        else:
+            if c == 44 and column > 0:
+                row += 1
+                column = 0
+            # '|' and anything unexpected just separate values
+            i += 1
+    return result
+
+
+def _consume_actions(reader):
+    compressed_byte_count = reader.int()
+    compressed_data = reader.bytes(compressed_byte_count)
     decompressed_data = lzma.decompress(compressed_data)
-    return _parse_actions(decompressed_data.decode("ascii"))
+    return _parse_actions(decompressed_data)
 
 def _parse_actions(data):
-    raw_actions = pd.read_csv(
-        io.StringIO(data),
-        delimiter="|",
-        lineterminator=",",
-        dtype="f",
-        header=None
-    ).to_numpy()
+    if isinstance(data, str):
+        data = data.encode("ascii")
+    return _click_frames(_tokenize_actions(np.frombuffer(data, dtype=np.uint8)))
 
+def _click_frames(raw_actions):
+    """
+    Returns (time, x, y, v_x, v_y) for each frame where a button is newly
+    pressed, from raw (w, x, y, z) actions
+    """
     if raw_actions.size != 0 and raw_actions[-1,0] == -12345:
         # actions can contain an element with time offset -12345 at the end
         # which is used to contain an RNG seed, we should ignore it
@@ -67,7 +216,7 @@ def _parse_actions(data):
 
 
 class FastReplay(Replay):
-    """Lightweight replay class that only collects click positions, using pandas/numpy to speed up parsing
+    """Lightweight replay class that only collects click positions, using numba/numpy to speed up parsing
     """
 
     def difficulty_mods(self):
@@ -97,29 +246,29 @@ class FastReplay(Replay):
             Raised when ``data`` is not in the ``.osr`` format.
         """
 
-        buffer = bytearray(data)
+        reader = _Reader(data)
 
-        mode = GameMode(consume_byte(buffer))
+        mode = GameMode(reader.byte())
         if mode != GameMode.standard:
             raise GameModeNotSupported(mode)
 
-        version = consume_int(buffer)
-        beatmap_md5 = consume_string(buffer)
-        player_name = consume_string(buffer)
-        replay_md5 = consume_string(buffer)
-        count_300 = consume_short(buffer)
-        count_100 = consume_short(buffer)
-        count_50 = consume_short(buffer)
-        count_geki = consume_short(buffer)
-        count_katu = consume_short(buffer)
-        count_miss = consume_short(buffer)
-        score = consume_int(buffer)
-        max_combo = consume_short(buffer)
-        full_combo = bool(consume_byte(buffer))
-        mod_mask = consume_int(buffer)
-        life_bar_graph = consume_string(buffer)
-        timestamp = consume_datetime(buffer)
-        actions = _consume_actions(buffer)
+        version = reader.int()
+        beatmap_md5 = reader.string()
+        player_name = reader.string()
+        replay_md5 = reader.string()
+        count_300 = reader.short()
+        count_100 = reader.short()
+        count_50 = reader.short()
+        count_geki = reader.short()
+        count_katu = reader.short()
+        count_miss = reader.short()
+        score = reader.int()
+        max_combo = reader.short()
+        full_combo = bool(reader.byte())
+        mod_mask = reader.int()
+        life_bar_graph = reader.string()
+        timestamp = reader.datetime()
+        actions = _consume_actions(reader)
 
         mod_kwargs = Mod.unpack(mod_mask)
         # delete the alias field names
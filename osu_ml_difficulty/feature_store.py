@@ -0,0 +1,146 @@
+"""
+Consolidated replay feature storage.
+
+Features for all of a user's replays are concatenated into one array file,
+with an index giving the rows belonging to each replay. This lets features be
+read as slices of a memory map rather than opening one small file per replay.
+"""
+
+import os
+import glob
+from functools import lru_cache
+
+import numpy as np
+
+from osu_ml_difficulty import config
+
+
+INDEX_DTYPE = np.dtype([("replay_id", "<i8"), ("offset", "<i8"), ("count", "<i8")])
+
+
+def features_path(user_id):
+    return os.path.join(config.REPLAY_FEATURE_PATH, f"user-{user_id}.features.npy")
+
+def index_path(user_id):
+    return os.path.join(config.REPLAY_FEATURE_PATH, f"user-{user_id}.index.npy")
+
+
+class FeatureStore:
+    """
+    Read only view of the packed features for a single user
+    """
+    def __init__(self, user_id):
+        index = np.load(index_path(user_id))
+        self.features = np.load(features_path(user_id), mmap_mode="r")
+        self.offsets = {
+            replay_id: (offset, count)
+            for replay_id, offset, count in index.tolist()
+        }
+
+    def __contains__(self, replay_id):
+        return replay_id in self.offsets
+
+    def load(self, replay_id):
+        """
+        Returns a zero-copy slice of the memory mapped features for a replay
+        """
+        offset, count = self.offsets[replay_id]
+        return self.features[offset:offset + count]
+
+
+@lru_cache(64)
+def get_store(user_id):
+    """
+    Returns the FeatureStore for a user, or None if their features haven't been packed
+    """
+    try:
+        return FeatureStore(user_id)
+    except FileNotFoundError:
+        return None
+
+
+def _replace(tmp_path, path):
+    try:
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def pack_user_features(user, remove_files=False):
+    """
+    Concatenate the features of all of a user's replays into a single store.
+
+    Replays are stored in timestamp order, so each training batch is a
+    contiguous region of the file. Returns the number of replays packed.
+    """
+    replays = list(user.replays.order_by(user.replays.model.timestamp))
+
+    # first pass only reads array headers, to find where each replay goes
+    shapes = []
+    for replay in replays:
+        try:
+            shapes.append(replay.load_features(mmap_mode="r").shape)
+        except FileNotFoundError:
+            shapes.append(None)
+
+    counts = np.array([s[0] if s else 0 for s in shapes], dtype="i8")
+    offsets = np.cumsum(counts) - counts
+    index = np.array(
+        [(r.id, o, c) for r, o, c, s in zip(replays, offsets, counts, shapes) if s],
+        dtype=INDEX_DTYPE
+    )
+    n_columns = next((s[1] for s in shapes if s), 0)
+
+    path = features_path(user.id)
+    tmp_path = path + ".tmp"
+    features = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype="f", shape=(int(counts.sum()), n_columns))
+    try:
+        for replay, offset, count, shape in zip(replays, offsets, counts, shapes):
+            if shape:
+                features[offset:offset + count] = replay.load_features()
+        features.flush()
+        del features
+    except:
+        os.remove(tmp_path)
+        raise
+
+    # an old index would point into the wrong rows of the new file, so remove
+    # it first. Readers then fall back to the per-replay files until the new
+    # index exists
+    if os.path.exists(index_path(user.id)):
+        os.remove(index_path(user.id))
+    _replace(tmp_path, path)
+    tmp_index_path = index_path(user.id) + ".tmp"
+    with open(tmp_index_path, "wb") as index_file:
+        np.save(index_file, index)
+    _replace(tmp_index_path, index_path(user.id))
+    get_store.cache_clear()
+
+    if remove_files:
+        for replay in replays:
+            if os.path.exists(replay.feature_path()):
+                os.remove(replay.feature_path())
+
+    return len(index)
+
+
+def remove_user_store(user_id):
+    """
+    Delete a user's packed feature store, e.g. when some of their features are
+    recalculated
+    """
+    for path in (index_path(user_id), features_path(user_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    get_store.cache_clear()
+
+
+def remove_stores():
+    """
+    Delete all packed feature stores, e.g. when features are recalculated
+    """
+    for path in glob.glob(os.path.join(config.REPLAY_FEATURE_PATH, "user-*.npy")):
+        os.remove(path)
+    get_store.cache_clear()
@@ -0,0 +1,201 @@
+"""
+Compact consolidated storage of replay click frames.
+
+Frames for all of a user's replays are packed into one memory mapped array,
+with an index giving the rows belonging to each replay, as feature_store does
+for features. Each frame is stored in 12 bytes rather than 20: the time as an
+integer delta from the previous click, the position quantized to int16 and the
+velocity as float16. Velocities can be left out, leaving 8 bytes per frame.
+
+Replay frame times are whole milliseconds, so times are stored exactly.
+Positions are scaled by the largest power of two up to MAX_POSITION_SCALE that
+fits the replay's positions in int16, so they're rounded to within 1/64 of an
+osu!pixel for replays whose cursor stays within 1024 pixels of the origin.
+Velocities are clipped to the float16 range, far beyond real cursor movement.
+"""
+
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from osu_ml_difficulty import config, frame
+
+
+FRAME_DTYPE = np.dtype([
+    ("dt", "<i4"), ("x", "<i2"), ("y", "<i2"), ("v_x", "<f2"), ("v_y", "<f2")
+])
+FRAME_DTYPE_NO_VELOCITY = np.dtype([("dt", "<i4"), ("x", "<i2"), ("y", "<i2")])
+INDEX_DTYPE = np.dtype([
+    ("replay_id", "<i8"), ("offset", "<i8"), ("count", "<i8"), ("position_scale", "<f4")
+])
+MAX_POSITION_SCALE = 64
+
+# increment when the encoding changes, as features extracted from packed frames
+# are versioned by it, see replay_features.PACKED_FEATURE_VERSION
+FRAME_FORMAT_VERSION = 1
+
+
+def frames_path(user_id):
+    return os.path.join(config.REPLAY_PATH, f"user-{user_id}.frames.npy")
+
+def index_path(user_id):
+    return os.path.join(config.REPLAY_PATH, f"user-{user_id}.frames-index.npy")
+
+
+def position_scale(positions):
+    """
+    Largest power of two, at most MAX_POSITION_SCALE, which fits positions in int16
+    """
+    extent = np.abs(positions).max(initial=1)
+    return min(MAX_POSITION_SCALE, 2.0 ** np.floor(np.log2(np.iinfo("i2").max / extent)))
+
+
+def encode_frames(frames, velocities=True):
+    """
+    Returns (rows, position scale) for an array of (n, frame.N_COLUMNS) frames
+    """
+    scale = position_scale(frames[:, frame.POS])
+    rows = np.empty(len(frames), dtype=FRAME_DTYPE if velocities else FRAME_DTYPE_NO_VELOCITY)
+    times = np.rint(frames[:, frame.TIME]).astype("i8")
+    rows["dt"] = np.diff(times, prepend=0)
+    rows["x"] = np.rint(frames[:, frame.X] * scale)
+    rows["y"] = np.rint(frames[:, frame.Y] * scale)
+    if velocities:
+        # frames with no time since the last one have huge velocities, which
+        # don't fit in float16
+        limit = np.finfo("f2").max
+        rows["v_x"] = np.clip(frames[:, frame.V_X], -limit, limit)
+        rows["v_y"] = np.clip(frames[:, frame.V_Y], -limit, limit)
+    return rows, scale
+
+
+def decode_frames(rows, scale):
+    """
+    Returns the (n, frame.N_COLUMNS) float32 frames for encoded rows, with nan
+    velocities if they weren't stored
+    """
+    frames = np.empty((len(rows), frame.N_COLUMNS), dtype="f")
+    frames[:, frame.TIME] = np.cumsum(rows["dt"], dtype="i8")
+    frames[:, frame.X] = rows["x"] / np.float32(scale)
+    frames[:, frame.Y] = rows["y"] / np.float32(scale)
+    if "v_x" in rows.dtype.names:
+        frames[:, frame.V_X] = rows["v_x"]
+        frames[:, frame.V_Y] = rows["v_y"]
+    else:
+        frames[:, frame.V] = np.nan
+    return frames
+
+
+class FrameStore:
+    """
+    Read only view of the packed frames for a single user
+    """
+    def __init__(self, user_id):
+        index = np.load(index_path(user_id))
+        self.frames = np.load(frames_path(user_id), mmap_mode="r")
+        self.offsets = {
+            replay_id: (offset, count, scale)
+            for replay_id, offset, count, scale in index.tolist()
+        }
+
+    def __contains__(self, replay_id):
+        return replay_id in self.offsets
+
+    @property
+    def velocities(self):
+        return "v_x" in self.frames.dtype.names
+
+    def load(self, replay_id):
+        """
+        Returns a new array of a replay's frames, as they were saved by import
+        """
+        offset, count, scale = self.offsets[replay_id]
+        return decode_frames(self.frames[offset:offset + count], scale)
+
+
+@lru_cache(64)
+def get_store(user_id):
+    """
+    Returns the FrameStore for a user, or None if their frames haven't been packed
+    """
+    try:
+        return FrameStore(user_id)
+    except FileNotFoundError:
+        return None
+
+
+def has_packed_frames(user_id, replay_id):
+    store = get_store(user_id)
+    return store is not None and replay_id in store
+
+
+def _replace(tmp_path, path):
+    try:
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def pack_user_frames(user, remove_files=False, velocities=True):
+    """
+    Encode the frames of all of a user's replays into a single store, in
+    timestamp order. Replays already in the user's store are repacked from it.
+    Returns the number of replays packed.
+    """
+    replays = list(user.replays.order_by(user.replays.model.timestamp))
+
+    encoded = []
+    for replay in replays:
+        try:
+            # prefer the saved file, which may have velocities the store doesn't
+            if os.path.exists(replay.frames_path()):
+                frames = np.load(replay.frames_path())
+            else:
+                frames = replay.load_frames()
+            encoded.append(encode_frames(frames, velocities))
+        except FileNotFoundError:
+            encoded.append(None)
+
+    counts = np.array([len(e[0]) if e else 0 for e in encoded], dtype="i8")
+    offsets = np.cumsum(counts) - counts
+    index = np.array(
+        [(r.id, o, c, e[1]) for r, o, c, e in zip(replays, offsets, counts, encoded) if e],
+        dtype=INDEX_DTYPE
+    )
+
+    path = frames_path(user.id)
+    tmp_path = path + ".tmp"
+    frames = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=FRAME_DTYPE if velocities else FRAME_DTYPE_NO_VELOCITY,
+        shape=(int(counts.sum()),))
+    try:
+        for offset, count, e in zip(offsets, counts, encoded):
+            if e:
+                frames[offset:offset + count] = e[0]
+        frames.flush()
+        del frames
+    except:
+        os.remove(tmp_path)
+        raise
+
+    # an old index would point into the wrong rows of the new file, so remove
+    # it first. Readers then fall back to the per-replay files until the new
+    # index exists
+    if os.path.exists(index_path(user.id)):
+        os.remove(index_path(user.id))
+    _replace(tmp_path, path)
+    tmp_index_path = index_path(user.id) + ".tmp"
+    with open(tmp_index_path, "wb") as index_file:
+        np.save(index_file, index)
+    _replace(tmp_index_path, index_path(user.id))
+    get_store.cache_clear()
+
+    if remove_files:
+        for replay in replays:
+            if os.path.exists(replay.frames_path()):
+                os.remove(replay.frames_path())
+
+    return len(index)
+
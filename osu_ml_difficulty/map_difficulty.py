@@ -1,23 +1,69 @@
-import tensorflow as tf
+import copy
+import logging
+import math
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import scipy.optimize as opt
 import numpy as np
+import numba
 import pandas as pd
 
-from .dataset import augment_beatmap_data
+from .dataset import gather_windows, note_features, pack_notes
 from .raleigh import CDF
-from .beatmap import MapData, lib
+from .beatmap import MapData, beatmap_md5_from_id, get_library
+from .difficulty_cache import DifficultyCache, model_hash
+from .numpy_model import load_model
+from .result_writer import open_writer
+from .util import chunks, ordered_map, parse_mods
+from . import metrics
+
 
 
+def evaluate_maps(model, map_notes, batch_size=8192):
+    """
+    Evaluate the notes of several maps, given the note_features of each, with
+    a single predict call.
 
-def evaluate_map(model, map_data):
-    augmented = augment_beatmap_data(map_data)
-    return np.maximum(model.predict(augmented)+10,0)
+    Returns a list of note difficulties for each map
+    """
+    lengths = [len(notes) for notes in map_notes]
+    notes, starts = pack_notes(map_notes)
+    note_index = np.concatenate([start + np.arange(length) for start, length in zip(starts, lengths)])
+    difficulties = model.predict(gather_windows(notes, note_index), batch_size=batch_size, verbose=0)
+    return np.split(np.maximum(difficulties+10,0), np.cumsum(lengths)[:-1])
+
+def evaluate_map(model, map_data, cache=None, beatmap_md5=None):
+    """
+    Note difficulties of a map. Given a DifficultyCache for the model and the
+    map's md5, they're read from the cache, or evaluated and stored if they
+    aren't cached yet.
+    """
+    if cache is None or beatmap_md5 is None:
+        return evaluate_maps(model, [note_features(map_data)])[0]
+    mods = [m for m in mod_names if getattr(map_data, m)]
+    cached = cache.get(beatmap_md5, mods)
+    if cached is not None:
+        return cached["note_difficulties"]
+    note_difficulties = evaluate_maps(model, [note_features(map_data)])[0]
+    skill = get_map_required_skills([note_difficulties])[0]
+    cache.put(beatmap_md5, mods, note_difficulties, skill, map_data.beatmap_name)
+    return note_difficulties
 
 
 def fc_probability(difficulties, skill):
     return np.prod(CDF(x=1, sigma=difficulties*(1/skill)))
 
 
+def log_fc_probability(difficulties, skill):
+    """
+    Log of fc_probability, which doesn't underflow on long maps
+    """
+    with np.errstate(divide="ignore"):
+        return np.sum(np.log(-np.expm1(-0.5 * np.square(skill / difficulties))))
+
+
 def get_map_required_skill(difficulties, probability_threshold=0.05): 
     return opt.root_scalar(
         lambda skill: fc_probability(difficulties, skill)-probability_threshold,
@@ -26,6 +72,117 @@ def get_map_required_skill(difficulties, probability_threshold=0.05):
         rtol=0.00001
         )
 
+
+@numba.njit(cache=True)
+def _log_fc_probability_and_derivative(inv_d2, skill_squared):
+    """
+    log fc probability of a map, and its derivative with respect to skill**2.
+
+    inv_d2 is 1/difficulty**2 for each note, sorted in ascending order (hardest
+    notes first)
+    """
+    log_p = 0.0
+    d_log_p = 0.0
+    for v in inv_d2:
+        # P(hit) = 1 - exp(-a)
+        a = 0.5 * skill_squared * v
+        if a > 36:
+            # P(hit) rounds to 1 in double precision for this and all easier notes
+            break
+        if a > 9:
+            # P(miss) < 1.3e-4, so a short series is exact to double precision
+            # and avoids evaluating a log for most notes
+            p_miss = math.exp(-a)
+            log_p -= p_miss * (1 + p_miss * (0.5 + p_miss * (1/3 + p_miss * 0.25)))
+            d_log_p += 0.5 * v * p_miss / (1 - p_miss)
+        else:
+            p_hit = -math.expm1(-a)
+            log_p += math.log(p_hit)
+            d_log_p += 0.5 * v * (1 - p_hit) / p_hit
+    return log_p, d_log_p
+
+
+@numba.njit(cache=True, parallel=True)
+def _solve_required_skills(inv_d2, offsets, target, lo_bound, hi_bound, tol, max_iterations):
+    """
+    Solves log(-log_p) = log(-target) for skill**2 with Newton steps.
+
+    log(-log_p) is close to a log-sum-exp of linear functions of skill**2, so
+    it's nearly linear and convex, and Newton's method converges quickly.
+    """
+    n_maps = offsets.shape[0] - 1
+    result = np.full(n_maps, np.nan)
+    for i in numba.prange(n_maps):
+        map_inv_d2 = inv_d2[offsets[i]:offsets[i+1]]
+        if map_inv_d2.shape[0] == 0:
+            continue
+        lo = lo_bound
+        hi = hi_bound
+
+        # the hardest note alone must have P(hit) >= threshold, giving a lower
+        # bound on skill. A map where every note is as hard as the hardest note
+        # gives an upper bound. Only check the bracket when they don't.
+        y = -2 * math.log(-math.expm1(target)) / map_inv_d2[0]
+        y_max = -2 * math.log(-math.expm1(target / map_inv_d2.shape[0])) / map_inv_d2[0]
+        if y < lo and _log_fc_probability_and_derivative(map_inv_d2, lo)[0] > target:
+            continue
+        if y_max > hi and _log_fc_probability_and_derivative(map_inv_d2, hi)[0] < target:
+            continue
+        y = min(max(y, lo), hi)
+
+        for _ in range(max_iterations):
+            log_p, d_log_p = _log_fc_probability_and_derivative(map_inv_d2, y)
+            g = math.log(log_p / target) if log_p < 0 else -np.inf
+            if g == 0:
+                break
+            if g > 0:
+                lo = y
+            else:
+                hi = y
+
+            y_new = y - g * log_p / d_log_p
+            if not lo < y_new < hi:
+                y_new = math.sqrt(lo * hi)
+
+            converged = abs(y_new - y) < tol * y
+            y = y_new
+            if converged:
+                break
+        result[i] = math.sqrt(y)
+    return result
+
+
+def get_map_required_skills(difficulty_list, probability_threshold=0.05, bracket=(0.1, 200), tol=1e-10, max_iterations=100):
+    """
+    Vectorized equivalent of get_map_required_skill for a list of maps.
+
+    Solves log fc_probability(skill) = log probability_threshold for all maps in
+    parallel, using Newton steps with the analytic derivative, and bisection
+    when a step leaves the bracket. Working in log space avoids fc_probability
+    underflowing to zero on long maps.
+
+    Returns an array of skills, with nan for maps with no root in the bracket.
+    """
+    difficulties = [np.ravel(d).astype("d") for d in difficulty_list]
+    with np.errstate(divide="ignore"):
+        inv_d2 = [1 / np.square(d) for d in difficulties]
+    # zero difficulty notes are always hit, so don't affect the probability
+    inv_d2 = [np.sort(v[np.isfinite(v)]) for v in inv_d2]
+
+    offsets = np.zeros(len(inv_d2) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in inv_d2], out=offsets[1:])
+
+    return _solve_required_skills(
+        np.concatenate(inv_d2) if inv_d2 else np.zeros(0),
+        offsets,
+        np.log(probability_threshold),
+        bracket[0]**2,
+        bracket[1]**2,
+        tol,
+        max_iterations
+    )
+
+
 mod_names = {
     "dt": "double_time",
     "hd": "hidden",
@@ -34,22 +191,100 @@ mod_names = {
     "ht": "half_time",
 }
 
-def map_required_skills_from_csv(map_csv, model_path="model.keras"):
-    model = tf.keras.models.load_model(model_path)
+def _load_map(row, cache=None):
+    """
+    Load a map's note features from a map list row, returning None if it can't
+    be found, or has invalid mods or can't be parsed, so that one bad row
+    doesn't stop the rest of the list.
 
-    maplist = pd.read_csv(map_csv)
-    maplist["Mods"].fillna("", inplace=True)
-    print("id","name","mods","difficulty","peak_difficulty","ppv2_aim",sep=";")
-    for _, row in maplist.iterrows():
-        try:
-            beatmap_id = row["ID"]
-            mods = {m:True for m in row["Mods"].split(" ") if m}
-            beatmap = lib.lookup_by_id(beatmap_id)
+    If the map is in the cache, it isn't loaded, and the cache entry is returned
+    instead of its notes.
+    """
+    beatmap_id, mods_string = row
+    try:
+        mods = {m: True for m in parse_mods(mods_string)}
+    except ValueError as e:
+        logging.error("skipping map %s: %s", beatmap_id, e)
+        metrics.inc("invalid_rows")
+        return None
+    mods_string = " ".join(mods)
+    try:
+        with metrics.timer("load_map"):
+            beatmap_md5 = None
+            if cache is not None:
+                beatmap_md5 = beatmap_md5_from_id(beatmap_id)
+                cached = cache.get(beatmap_md5, mods)
+                # entries stored by evaluate_map don't have ppv2_aim
+                if cached is not None and not np.isnan(cached["ppv2_aim"]):
+                    return beatmap_id, beatmap_md5, cached["name"], mods_string, None, cached["ppv2_aim"], cached
+            # slider resolves stacking in place on its cached beatmap, so use a
+            # copy to avoid depending on which mods were loaded first
+            beatmap = copy.deepcopy(get_library().lookup_by_id(beatmap_id))
             map_data = MapData.from_beatmap(beatmap,**mods)
-
-            note_difficulties = evaluate_map(model, map_data)
-            skill = get_map_required_skill(note_difficulties)
             ppv2_aim = beatmap.aim_stars(**{mod_names[m]: True for m in mods if m != "hd"})
-            print(beatmap_id,map_data.beatmap_name.replace(";",","),row["Mods"],skill.root,np.max(note_difficulties),ppv2_aim,sep=";")
-        except KeyError:
-            pass
+            notes = note_features(map_data)
+    except KeyError:
+        metrics.inc("maps_not_found")
+        return None
+    except Exception:
+        logging.exception("error loading map %s", beatmap_id)
+        metrics.inc("map_errors")
+        return None
+    return beatmap_id, beatmap_md5, map_data.beatmap_name, mods_string, notes, ppv2_aim, None
+
+def map_required_skills_from_csv(map_csv, model_path="model.keras", workers=1, maps_per_batch=256, use_cache=True, output=None):
+    """
+    Print the required skill of each map in a map list, or write it to output,
+    see result_writer.open_writer.
+
+    model_path is a keras model, or a .npz model written by the export command,
+    which is evaluated without tensorflow.
+
+    Maps are loaded by worker processes while the main process evaluates them in
+    batches of maps_per_batch maps, with one predict call per batch. Output is in
+    the same order as the map list.
+
+    With use_cache, maps this model has already evaluated are read from the
+    difficulty cache instead of being loaded and evaluated again.
+    """
+    model = load_model(model_path)
+    cache = DifficultyCache(model_hash(model)) if use_cache else None
+    load_map = partial(_load_map, cache=cache)
+
+    maplist = pd.read_csv(map_csv)
+    maplist["Mods"] = maplist["Mods"].fillna("")
+    rows = zip(maplist["ID"], maplist["Mods"])
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers)
+        maps = metrics.merged(ordered_map(executor, partial(metrics.collecting, load_map), rows, max_pending=2*maps_per_batch))
+    else:
+        executor = None
+        maps = map(load_map, rows)
+
+    try:
+        with closing(open_writer(output)) as writer:
+            for chunk in chunks((m for m in maps if m is not None), maps_per_batch):
+                results = [
+                    None if cached is None else (cached["note_difficulties"], cached["required_skill"])
+                    for *_, cached in chunk
+                ]
+                missed = [i for i, result in enumerate(results) if result is None]
+                if missed:
+                    with metrics.timer("evaluate_maps"):
+                        all_note_difficulties = evaluate_maps(model, [chunk[i][4] for i in missed])
+                    with metrics.timer("required_skills"):
+                        skills = get_map_required_skills(all_note_difficulties)
+                    metrics.inc("maps_evaluated", len(missed))
+                    for i, note_difficulties, skill in zip(missed, all_note_difficulties, skills):
+                        results[i] = note_difficulties, skill
+                        if cache is not None:
+                            _, beatmap_md5, name, mods_string, _, ppv2_aim, _ = chunk[i]
+                            cache.put(beatmap_md5, mods_string.split(), note_difficulties, skill, name, ppv2_aim)
+                writer.write([
+                    (beatmap_id, name, mods_string, skill, note_difficulties, ppv2_aim)
+                    for (beatmap_id, _, name, mods_string, _, ppv2_aim, _), (note_difficulties, skill) in zip(chunk, results)
+                ])
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,172 @@
+"""
+Mod independent beatmap storage.
+
+Hit objects for every map are concatenated into one raw array file, with an
+index from md5 to the rows belonging to each map. Each row holds the time and
+stacked position of a hit object with and without hard rock, which flips
+positions before stacking. Other mods only rescale time or change CS, so every
+mod combination can be derived in memory from a single entry per map.
+"""
+
+import os
+import logging
+from functools import lru_cache
+
+import numpy as np
+
+from osu_ml_difficulty import config
+
+
+# time (ms), then x, y without and with hard rock. Like MapData.from_beatmap,
+# easy maps use no mod positions
+HIT_OBJECT_COLUMNS = 5
+POSITION_COLUMNS = {False: slice(1, 3), True: slice(3, 5)}
+
+INDEX_FIELDS = [
+    ("md5", "S32"), ("offset", "<i8"), ("count", "<i8"), ("beatmap_id", "<i8"),
+    ("cs", "<f8"), ("cs_hr", "<f8"), ("cs_ez", "<f8"),
+    ("od", "<f8"), ("od_hr", "<f8"), ("od_ez", "<f8")
+]
+
+
+class OutdatedStore(Exception):
+    """
+    Raised when the store was written by an older version, without every index
+    field or for an older beatmap.MAP_DATA_VERSION
+    """
+
+
+def hit_objects_path():
+    return os.path.join(config.MAP_STORE_PATH, "hit_objects.bin")
+
+def index_path():
+    return os.path.join(config.MAP_STORE_PATH, "index.npy")
+
+def version_path():
+    return os.path.join(config.MAP_STORE_PATH, "version")
+
+
+def scale_time(time, coefficient):
+    """
+    Scale hit object times the same way as slider, which rounds to whole
+    microseconds
+    """
+    return np.round(np.round(time * 1e3) * coefficient) / 1e6 * 1e3
+
+
+class MapStore:
+    """
+    Read only view of the map store, which must have been written for
+    map data version
+    """
+    def __init__(self, version):
+        self.index = np.load(index_path())
+        try:
+            with open(version_path()) as version_file:
+                store_version = int(version_file.read())
+        except FileNotFoundError:
+            store_version = None
+        if store_version != version:
+            raise OutdatedStore(f"map store has map data version {store_version}, expected {version}")
+        missing = [name for name, _ in INDEX_FIELDS if name not in self.index.dtype.names]
+        if missing:
+            raise OutdatedStore(f"map store index is missing {', '.join(missing)}")
+        row_count = int(self.index["count"].sum())
+        if row_count:
+            self.hit_objects = np.memmap(
+                hit_objects_path(), dtype="<f8", mode="r", shape=(row_count, HIT_OBJECT_COLUMNS))
+        else:
+            # an empty file can't be memory mapped
+            self.hit_objects = np.zeros((0, HIT_OBJECT_COLUMNS))
+        self.rows = {md5.decode(): i for i, md5 in enumerate(self.index["md5"])}
+
+    def __contains__(self, beatmap_md5):
+        return beatmap_md5 in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load(self, beatmap_md5, dt=False, hr=False, ez=False, ht=False):
+        """
+        Returns (hit_objects, cs, od, beatmap_id, beatmap_name) with mods applied
+        """
+        entry = self.index[self.rows[beatmap_md5]]
+        rows = self.hit_objects[entry["offset"]:entry["offset"] + entry["count"]]
+        time = rows[:, 0]
+        if dt:
+            time = scale_time(time, 2/3)
+        elif ht:
+            time = scale_time(time, 4/3)
+
+        hit_objects = np.column_stack((time, rows[:, POSITION_COLUMNS[hr]])).astype("f")
+        cs = entry["cs_hr"] if hr else entry["cs_ez"] if ez else entry["cs"]
+        od = entry["od_hr"] if hr else entry["od_ez"] if ez else entry["od"]
+        beatmap_id = int(entry["beatmap_id"]) if entry["beatmap_id"] >= 0 else None
+        return hit_objects, float(cs), float(od), beatmap_id, str(entry["name"])
+
+
+@lru_cache(1)
+def get_store(version):
+    """
+    Returns the MapStore, or None if it hasn't been built or was built for
+    another map data version
+    """
+    try:
+        return MapStore(version)
+    except FileNotFoundError:
+        return None
+    except OutdatedStore as e:
+        logging.warning("%s, run pack-maps to rebuild it. Parsing maps instead", e)
+        return None
+
+
+def _replace(tmp_path, path):
+    try:
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def write_store(entries, version):
+    """
+    Write a new map store from
+    (md5, beatmap_id, name, (cs, cs_hr, cs_ez), (od, od_hr, od_ez), hit_objects)
+    entries, where hit_objects has HIT_OBJECT_COLUMNS columns, for map data
+    version.
+
+    Hit objects are streamed to disk, so only the index is kept in memory.
+    Returns the number of maps stored.
+    """
+    os.makedirs(config.MAP_STORE_PATH, exist_ok=True)
+    index = []
+    offset = 0
+    tmp_path = hit_objects_path() + ".tmp"
+    try:
+        with open(tmp_path, "wb") as hit_objects_file:
+            for md5, beatmap_id, name, cs, od, hit_objects in entries:
+                hit_objects = np.ascontiguousarray(hit_objects, dtype="<f8")
+                hit_objects_file.write(hit_objects.tobytes())
+                index.append((md5, offset, len(hit_objects), beatmap_id, *cs, *od, name))
+                offset += len(hit_objects)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    name_length = max((len(entry[-1]) for entry in index), default=1)
+    index = np.array(index, dtype=INDEX_FIELDS + [("name", f"<U{name_length}")])
+
+    # an old index would point into the wrong rows of the new file, so remove
+    # it first. Readers then fall back to parsing maps until the new one exists
+    if os.path.exists(index_path()):
+        os.remove(index_path())
+    _replace(tmp_path, hit_objects_path())
+    with open(version_path(), "w") as version_file:
+        version_file.write(str(version))
+    tmp_index_path = index_path() + ".tmp"
+    with open(tmp_index_path, "wb") as index_file:
+        np.save(index_file, index)
+    _replace(tmp_index_path, index_path())
+    get_store.cache_clear()
+
+    return len(index)
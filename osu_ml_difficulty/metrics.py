@@ -0,0 +1,306 @@
+"""
+Counters, per stage timing histograms and peak memory for long running jobs.
+
+Metrics are kept per process. Work done in worker processes is recorded in the
+worker, and sent back with its results by wrapping the work in collecting(),
+then merged into the main process with merge().
+
+start() periodically writes the metrics of the main process to a file, as
+Prometheus text format if it ends in .prom and JSON otherwise, and prints a
+summary on exit.
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+PROMETHEUS_PREFIX = "osu_ml_difficulty"
+
+# upper bounds of timing histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, counts, total, maximum):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.max = max(self.max, maximum)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket containing quantile q
+        """
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+_lock = threading.Lock()
+_counters = {}
+_stages = {}
+_worker_peak_rss = 0
+_start_time = time.time()
+
+_owner_pid = None
+_reporter = None
+
+
+def _reset():
+    global _lock, _counters, _stages, _worker_peak_rss, _start_time, _owner_pid, _reporter
+    # the reporter thread may have held the lock when the process forked
+    _lock = threading.Lock()
+    _counters = {}
+    _stages = {}
+    _worker_peak_rss = 0
+    _start_time = time.time()
+    _owner_pid = None
+    _reporter = None
+
+# forked workers start with a copy of the parent's metrics, which would be
+# counted twice when merged back
+os.register_at_fork(after_in_child=_reset)
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None if unknown
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def inc(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def observe(stage, seconds):
+    with _lock:
+        if stage not in _stages:
+            _stages[stage] = Histogram()
+        _stages[stage].observe(seconds)
+
+@contextmanager
+def timer(stage):
+    """
+    Record the time taken by a block in the stage's histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def drain():
+    """
+    Returns the metrics recorded in a worker process since the last drain, and
+    resets them. Returns None in the process which called start(), where
+    metrics are already recorded in the right place.
+    """
+    global _counters, _stages
+    if os.getpid() == _owner_pid:
+        return None
+    with _lock:
+        counters, stages = _counters, _stages
+        _counters, _stages = {}, {}
+    return dict(
+        counters=counters,
+        stages={name: (h.counts, h.sum, h.max) for name, h in stages.items()},
+        peak_rss=peak_rss() or 0,
+    )
+
+def merge(worker_metrics):
+    """
+    Add metrics returned by drain() in a worker process
+    """
+    global _worker_peak_rss
+    if worker_metrics is None:
+        return
+    with _lock:
+        for name, value in worker_metrics["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+        for name, histogram in worker_metrics["stages"].items():
+            if name not in _stages:
+                _stages[name] = Histogram()
+            _stages[name].merge(*histogram)
+        _worker_peak_rss = max(_worker_peak_rss, worker_metrics["peak_rss"])
+
+def collecting(func, *args, **kwargs):
+    """
+    Call func, and return (result, metrics it recorded in this worker process).
+    Use as partial(collecting, func) to send metrics back from an executor.
+    """
+    result = func(*args, **kwargs)
+    return result, drain()
+
+
+def merged(results):
+    """
+    Yields results from (result, worker metrics) pairs returned by
+    collecting(), merging the metrics as it goes
+    """
+    for result, worker_metrics in results:
+        merge(worker_metrics)
+        yield result
+
+
+def to_dict():
+    with _lock:
+        return dict(
+            time=time.time(),
+            uptime_seconds=time.time() - _start_time,
+            peak_rss_bytes=peak_rss(),
+            worker_peak_rss_bytes=_worker_peak_rss or None,
+            counters=dict(_counters),
+            stages={
+                name: dict(
+                    count=h.count,
+                    sum_seconds=h.sum,
+                    max_seconds=h.max,
+                    buckets={str(bound): count for bound, count in zip(BUCKETS, h.counts)},
+                )
+                for name, h in _stages.items()
+            },
+        )
+
+def to_prometheus():
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+        if _stages:
+            metric = f"{PROMETHEUS_PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, h in sorted(_stages.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{metric}_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'{metric}_count{{stage="{name}"}} {h.count}')
+
+        gauges = [("peak_rss_bytes", peak_rss()), ("worker_peak_rss_bytes", _worker_peak_rss or None)]
+        for name, value in gauges:
+            if value is not None:
+                metric = f"{PROMETHEUS_PREFIX}_{name}"
+                lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+def write(path):
+    """
+    Write metrics to path, replacing it atomically so readers never see a
+    partial file
+    """
+    if path.endswith(".prom"):
+        text = to_prometheus()
+    else:
+        text = json.dumps(to_dict(), indent=2)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as metrics_file:
+        metrics_file.write(text)
+    os.replace(tmp_path, path)
+
+
+def _format_bytes(value):
+    return f"{value / 2**20:.0f}MiB"
+
+def summary():
+    """
+    Returns a human readable summary of counters and stage timings
+    """
+    metrics = to_dict()
+    uptime = metrics["uptime_seconds"]
+    memory = []
+    if metrics["peak_rss_bytes"]:
+        memory.append(f"peak RSS {_format_bytes(metrics['peak_rss_bytes'])}")
+    if metrics["worker_peak_rss_bytes"]:
+        memory.append(f"worker peak RSS {_format_bytes(metrics['worker_peak_rss_bytes'])}")
+
+    lines = [f"Metrics after {uptime:.1f}s" + (f", {', '.join(memory)}" if memory else "") + ":"]
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append(f"  {name}: {value} ({value / uptime:.1f}/sec)")
+    with _lock:
+        stages = sorted(_stages.items())
+    for name, h in stages:
+        lines.append(
+            f"  {name}: {h.count} calls, {h.sum:.2f}s total, mean {h.sum / h.count * 1e3:.1f}ms, "
+            f"p95 <= {h.quantile(0.95) * 1e3:.1f}ms, max {h.max * 1e3:.1f}ms"
+        )
+    return "\n".join(lines)
+
+
+class _Reporter(threading.Thread):
+    def __init__(self, path, interval):
+        super().__init__(daemon=True, name="metrics-reporter")
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write(self.path)
+
+def _stop():
+    if _owner_pid != os.getpid():
+        return
+    if _reporter is not None:
+        _reporter.stopped.set()
+        write(_reporter.path)
+    if _counters or _stages:
+        # stderr, so it doesn't end up in output like map-list's csv
+        print(file=sys.stderr)
+        print(summary(), file=sys.stderr)
+
+def start(path=None, interval=10.0):
+    """
+    Record metrics for this process, writing them to path every interval
+    seconds if given, and print a summary on exit
+    """
+    global _owner_pid, _reporter, _start_time
+    if _owner_pid is not None:
+        return
+    _owner_pid = os.getpid()
+    _start_time = time.time()
+    if path is not None:
+        _reporter = _Reporter(path, interval)
+        _reporter.start()
+    atexit.register(_stop)
@@ -0,0 +1,110 @@
+"""
+Evaluate difficulty models with numpy, without importing tensorflow.
+
+export() writes the weights of a trained keras model to a .npz file, folding
+batch normalization into the following dense layer, and NumpyModel evaluates
+it with a matrix multiply per layer.
+"""
+
+import numpy as np
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+}
+
+
+def _dense_layers(model):
+    """
+    Returns (kernel, bias, activation) for each dense layer of a keras model,
+    with batch normalization folded into the next dense layer
+    """
+    layers = []
+    # batch normalization is x * scale + shift
+    scale = None
+    shift = None
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind in ("InputLayer", "Flatten", "Dropout"):
+            continue
+        elif kind == "BatchNormalization":
+            gamma, beta, mean, variance = [np.asarray(w, dtype="d") for w in layer.get_weights()]
+            scale = gamma / np.sqrt(variance + layer.epsilon)
+            shift = beta - mean * scale
+        elif kind == "Dense":
+            kernel, bias = [np.asarray(w, dtype="d") for w in layer.get_weights()]
+            if scale is not None:
+                bias = bias + shift @ kernel
+                kernel = scale[:, None] * kernel
+                scale = shift = None
+            layers.append((kernel, bias, layer.get_config()["activation"]))
+        else:
+            raise ValueError(f"Can't export {kind} layer {layer.name}")
+    if scale is not None:
+        raise ValueError("Can't export a model ending in batch normalization")
+    for _, _, activation in layers:
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Can't export {activation} activation")
+    return layers
+
+
+def export(model, path):
+    """
+    Write the weights of a keras model to a .npz file for NumpyModel
+    """
+    layers = _dense_layers(model)
+    arrays = {}
+    for i, (kernel, bias, _) in enumerate(layers):
+        arrays[f"kernel{i}"] = kernel.astype("float32")
+        arrays[f"bias{i}"] = bias.astype("float32")
+    np.savez(
+        path,
+        input_shape=np.array(model.input_shape[1:]),
+        activations=np.array([activation for _, _, activation in layers]),
+        **arrays
+    )
+
+
+class NumpyModel:
+    """
+    A model exported by export(), with the same predict() as a keras model
+    """
+    def __init__(self, input_shape, layers):
+        self.input_shape = (None, *input_shape)
+        self.layers = layers
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            activations = [str(activation) for activation in data["activations"]]
+            layers = [
+                (data[f"kernel{i}"], data[f"bias{i}"], activation)
+                for i, activation in enumerate(activations)
+            ]
+            return cls(tuple(data["input_shape"]), layers)
+
+    def get_weights(self):
+        return [w for kernel, bias, _ in self.layers for w in (kernel, bias)]
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype="float32").reshape((len(x), -1))
+        for kernel, bias, activation in self.layers:
+            x = ACTIVATIONS[activation](x @ kernel + bias)
+        return x
+
+    def predict(self, x, batch_size=8192, verbose=0):
+        if len(x) <= batch_size:
+            return self(x)
+        return np.concatenate([self(x[i:i+batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def load_model(path):
+    """
+    Load a model exported by export() if path ends in .npz, otherwise a keras
+    model
+    """
+    if str(path).endswith(".npz"):
+        return NumpyModel.load(path)
+    import tensorflow as tf
+    return tf.keras.models.load_model(path)
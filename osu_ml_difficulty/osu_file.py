@@ -0,0 +1,364 @@
+"""
+Lightweight .osu parser, which reads only what MapData needs.
+
+slider builds a full Beatmap with timing point, hit object, slider tick and
+timedelta objects for every map, most of which we never use. This reads hit
+object times and positions straight into arrays, and ports slider's stacking so
+the results are identical. Slider curves are still built with slider, but only
+to find slider end positions for stacking.
+"""
+
+import math
+import re
+from bisect import bisect_right
+from datetime import timedelta
+
+import numpy as np
+from slider.curve import Curve
+from slider.mod import ar_to_ms, circle_radius
+from slider.position import Position
+
+
+CIRCLE = 1
+SLIDER = 2
+SPINNER = 8
+
+STACK_DISTANCE = 3
+
+_VERSION_REGEX = re.compile(r"^osu file format v(\d+)$")
+_MAPPING_SECTIONS = {"General", "Metadata", "Difficulty"}
+
+
+class UnsupportedBeatmap(Exception):
+    """
+    Raised for maps this parser doesn't handle, which should be parsed with slider
+    """
+
+
+def _microseconds(milliseconds):
+    """
+    Convert to integer microseconds, rounding the same way as timedelta
+    """
+    return timedelta(milliseconds=milliseconds) // timedelta(microseconds=1)
+
+
+def _curve_end_bound(kind, points, pixel_length):
+    """
+    Upper bound on the distance between a slider's start and slider's curve(1),
+    so that most sliders can be ruled out of a stack without building a curve.
+
+    Bezier segments stay within their control points until they're extrapolated
+    to make up pixel_length. A degree n segment evaluated at t > 1 moves at most
+    (2t - 1)**n times its furthest control point from its start, and the
+    sampled length slider uses is at least the chord, which bounds t.
+    """
+    start = points[0]
+    furthest = max(math.dist(start, p) for p in points)
+
+    # the last segment, after the last pair of duplicate points
+    segment_start = 0
+    for i in range(1, len(points)):
+        if points[i] == points[i-1]:
+            segment_start = i
+    segment = points[segment_start:]
+    if kind == "L":
+        segment = points[-2:]
+
+    chords = sum(math.dist(a, b) for a, b in zip(points, points[1:]))
+    last_chord = math.dist(segment[0], segment[-1])
+    if last_chord == 0:
+        return math.inf
+    t = 1 + max(0, pixel_length - chords) / last_chord
+    extrapolated = (
+        math.dist(start, segment[0])
+        + (2*t - 1) ** (len(segment) - 1) * max(math.dist(segment[0], p) for p in segment)
+    )
+
+    bound = max(furthest, extrapolated)
+    if kind == "P":
+        # perfect circle arcs are at most pixel_length long
+        bound = max(bound, pixel_length)
+    return bound
+
+
+def _sections(lines):
+    sections = {}
+    section = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("//"):
+            continue
+        if line[0] == "[" and line[-1] == "]":
+            section = sections[line[1:-1]] = []
+        elif section is not None:
+            section.append(line)
+
+    for name in _MAPPING_SECTIONS & sections.keys():
+        mapping = {}
+        for line in sections[name]:
+            key, _, value = line.partition(":")
+            mapping[key.strip()] = value.strip()
+        sections[name] = mapping
+    return sections
+
+
+def _get(sections, section, field, default=None):
+    try:
+        return sections[section][field]
+    except KeyError:
+        if default is None:
+            raise ValueError(f"missing field {field!r} in section {section!r}")
+        return default
+
+
+def game_mode(path):
+    """
+    The game mode of a .osu file, 0 for standard, reading only as far as the
+    end of its [General] section
+    """
+    section = None
+    with open(path, encoding="utf-8-sig", errors="replace") as osu_file:
+        for line in osu_file:
+            line = line.strip()
+            if line.startswith("[") and line.endswith("]"):
+                if section == "General":
+                    break
+                section = line[1:-1]
+            elif section == "General":
+                key, _, value = line.partition(":")
+                if key.strip() == "Mode":
+                    return int(value)
+    return 0
+
+
+class OsuFile:
+    """
+    Hit objects of a standard mode .osu file, with format version 6 or later
+    """
+    def __init__(self, data):
+        lines = iter(data.lstrip().splitlines())
+        match = _VERSION_REGEX.match(next(lines, ""))
+        if match is None:
+            raise ValueError("missing osu file format specifier")
+        self.format_version = int(match.group(1))
+        if self.format_version < 6:
+            # older maps use a different stacking algorithm
+            raise UnsupportedBeatmap(f"format version {self.format_version}")
+
+        sections = _sections(lines)
+        if int(_get(sections, "General", "Mode", "0")) != 0:
+            raise UnsupportedBeatmap("not a standard mode map")
+
+        self.stack_leniency = float(_get(sections, "General", "StackLeniency", "0"))
+        self.display_name = "{} - {} [{}]".format(
+            _get(sections, "Metadata", "Artist"),
+            _get(sections, "Metadata", "Title"),
+            _get(sections, "Metadata", "Version"),
+        )
+        beatmap_id = _get(sections, "Metadata", "BeatmapID", "")
+        self.beatmap_id = int(beatmap_id) if beatmap_id else None
+
+        od = _get(sections, "Difficulty", "OverallDifficulty")
+        self.overall_difficulty = float(od)
+        self.circle_size = float(_get(sections, "Difficulty", "CircleSize"))
+        self.approach_rate = float(_get(sections, "Difficulty", "ApproachRate", od))
+        self.slider_multiplier = float(_get(sections, "Difficulty", "SliderMultiplier", "1.4"))
+
+        self._parse_timing_points(sections.get("TimingPoints", []))
+        self._parse_hit_objects(sections.get("HitObjects", []))
+        self._stacked = {}
+
+    @classmethod
+    def from_path(cls, path):
+        with open(path, encoding="utf-8-sig") as osu_file:
+            return cls(osu_file.read())
+
+    def _parse_timing_points(self, lines):
+        # (offset in microseconds, ms_per_beat, parent ms_per_beat or None)
+        self.timing_points = []
+        parent = None
+        for line in lines:
+            offset, ms_per_beat, *rest = line.split(",")
+            ms_per_beat = float(ms_per_beat)
+            inherited = len(rest) > 4 and not int(rest[4])
+            if inherited and parent is not None:
+                self.timing_points.append((_microseconds(float(offset)), ms_per_beat, parent))
+            else:
+                parent = ms_per_beat
+                self.timing_points.append((_microseconds(float(offset)), ms_per_beat, None))
+
+        self.timing_point_offsets = [offset for offset, _, _ in self.timing_points]
+        if self.timing_point_offsets != sorted(self.timing_point_offsets):
+            raise UnsupportedBeatmap("timing points out of order")
+
+    def _timing_point(self, time):
+        """
+        The timing point in effect at a time, or the first if time is before all of them
+        """
+        i = bisect_right(self.timing_point_offsets, time)
+        return self.timing_points[i-1 if i else 0]
+
+    def _parse_hit_objects(self, lines):
+        types = []
+        positions = []
+        times = []
+        end_times = []
+        # slider index -> (kind, points, pixel length)
+        self.curves = {}
+        self.curve_end_bounds = {}
+
+        for i, line in enumerate(lines):
+            x, y, time, type_, _hitsound, *rest = line.split(",")
+            x = int(float(x))
+            y = int(float(y))
+            time = int(time) * 1000
+            type_ = int(type_)
+
+            if type_ & CIRCLE:
+                type_ = CIRCLE
+                end_time = time
+            elif type_ & SLIDER:
+                type_ = SLIDER
+                kind, *raw_points = rest[0].split("|")
+                points = [Position(x, y)]
+                for point in raw_points:
+                    px, py = point.split(":")
+                    points.append(Position(int(px), int(py)))
+                repeat = int(rest[1])
+                pixel_length = float(rest[2])
+                self.curves[i] = (kind, points, pixel_length)
+                self.curve_end_bounds[i] = _curve_end_bound(kind, points, pixel_length)
+                end_time = time + self._slider_duration(time, repeat, pixel_length)
+            elif type_ & SPINNER:
+                type_ = SPINNER
+                end_time = int(rest[0]) * 1000
+            else:
+                raise UnsupportedBeatmap(f"hit object type {type_}")
+
+            types.append(type_)
+            positions.append((x, y))
+            times.append(time)
+            end_times.append(end_time)
+
+        self.types = np.array(types, dtype=np.int64)
+        self.positions = np.array(positions, dtype=np.float64).reshape(-1, 2)
+        # times are integer microseconds, so comparisons match slider's timedeltas
+        self.times = np.array(times, dtype=np.int64)
+        self.end_times = np.array(end_times, dtype=np.int64)
+
+    def _slider_duration(self, time, repeat, pixel_length):
+        _, ms_per_beat, parent_ms_per_beat = self._timing_point(time)
+        if parent_ms_per_beat is not None:
+            velocity_multiplier = np.clip(-100 / ms_per_beat, 0.1, 10)
+            ms_per_beat = parent_ms_per_beat
+        else:
+            velocity_multiplier = 1
+
+        pixels_per_beat = self.slider_multiplier * 100 * velocity_multiplier
+        num_beats = (pixel_length * repeat) / pixels_per_beat
+        return int(num_beats * ms_per_beat) * 1000
+
+    def cs(self, easy=False, hard_rock=False):
+        if hard_rock:
+            return min(1.3 * self.circle_size, 10)
+        if easy:
+            return self.circle_size / 2
+        return self.circle_size
+
+    def od(self, easy=False, hard_rock=False):
+        if hard_rock:
+            return min(1.4 * self.overall_difficulty, 10)
+        if easy:
+            return self.overall_difficulty / 2
+        return self.overall_difficulty
+
+    def hit_objects(self, hard_rock=False):
+        """
+        Returns times in microseconds and stacked positions of circles and
+        sliders, like slider's Beatmap.hit_objects(spinners=False, hard_rock=hard_rock)
+        """
+        if hard_rock not in self._stacked:
+            positions = np.copy(self.positions)
+            if hard_rock:
+                positions[:, 1] = 384 - positions[:, 1]
+            stack_height = self._stack_heights(positions, hard_rock)
+            stack_offset = circle_radius(self.cs(hard_rock=hard_rock)) / 10
+            positions -= (stack_offset * stack_height)[:, np.newaxis]
+
+            keep = self.types != SPINNER
+            self._stacked[hard_rock] = self.times[keep], positions[keep]
+        return self._stacked[hard_rock]
+
+    def _stack_heights(self, positions, hard_rock):
+        """
+        Port of slider's Beatmap._resolve_stacking, for format version 6 and later
+        """
+        ar = min(1.4 * self.approach_rate, 10) if hard_rock else self.approach_rate
+        stack_threshold = _microseconds(ar_to_ms(ar) * self.stack_leniency)
+
+        curve_ends = {}
+        def curve_end(i):
+            if i not in curve_ends:
+                kind, points, pixel_length = self.curves[i]
+                curve = Curve.from_kind_and_points(kind, points, pixel_length)
+                if hard_rock:
+                    curve = curve.hard_rock
+                curve_ends[i] = curve(1)
+            return curve_ends[i]
+
+        def distance(a, b):
+            return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+
+        def near_curve_end(i, position):
+            # the margin covers rounding error in slider's curve calculations
+            if distance(position_list[i], position) > self.curve_end_bounds[i] + STACK_DISTANCE + 1:
+                return False
+            return distance(curve_end(i), position) < STACK_DISTANCE
+
+        types = self.types.tolist()
+        times = self.times.tolist()
+        end_times = self.end_times.tolist()
+        position_list = positions.tolist()
+        stack_height = [0] * len(types)
+
+        # iterate backwards through the map, as slider does
+        for i in reversed(range(len(types))):
+            if stack_height[i] != 0 or types[i] == SPINNER:
+                continue
+
+            current = i
+            if types[i] == CIRCLE:
+                for n in reversed(range(i)):
+                    if types[n] == SPINNER:
+                        continue
+                    if times[current] - end_times[n] > stack_threshold:
+                        break
+
+                    if types[n] == SLIDER and near_curve_end(n, position_list[current]):
+                        offset = stack_height[current] - stack_height[n] + 1
+                        for j in range(i, n, -1):
+                            # objects under the slider end are offset below it
+                            if near_curve_end(n, position_list[j]):
+                                stack_height[j] -= offset
+                        break
+
+                    if distance(position_list[n], position_list[current]) < STACK_DISTANCE:
+                        stack_height[n] = stack_height[current] + 1
+                        current = n
+
+            elif types[i] == SLIDER:
+                for n in reversed(range(i)):
+                    if types[n] == SPINNER:
+                        continue
+                    if times[current] - times[n] > stack_threshold:
+                        break
+
+                    if types[n] == SLIDER:
+                        near = near_curve_end(n, position_list[current])
+                    else:
+                        near = distance(position_list[n], position_list[current]) < STACK_DISTANCE
+                    if near:
+                        stack_height[n] = stack_height[current] + 1
+                        current = n
+
+        return np.array(stack_height, dtype=np.float64)
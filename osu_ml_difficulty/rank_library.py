@@ -0,0 +1,153 @@
+"""
+Score every standard mode map in the library with a set of mod combinations.
+
+Maps are loaded by worker processes and evaluated in batches by the main
+process, streaming rows to the output file as each batch finishes. After each
+batch a checkpoint records the last map written and the length of the output,
+so an interrupted run resumes where it stopped, and memory use doesn't grow
+with the size of the library.
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from . import beatmap, metrics
+from .dataset import note_features
+from .difficulty_cache import model_hash
+from .map_difficulty import evaluate_maps, get_map_required_skills
+from .numpy_model import load_model
+from .osu_file import game_mode
+from .util import chunks, ordered_map, parse_mods
+
+COLUMNS = ("md5", "id", "name", "mods", "difficulty", "peak_difficulty")
+
+
+class CheckpointMismatch(ValueError):
+    """
+    The output has a checkpoint from a run with a different model or mods
+    """
+
+
+def parse_mod_sets(mod_sets):
+    """
+    Lists of mod names from strings like "hd+dt", "hr" or "nomod"
+    """
+    return [parse_mods("" if mods.lower() == "nomod" else mods) for mods in mod_sets]
+
+
+def checkpoint_path(output):
+    return output + ".checkpoint"
+
+def read_checkpoint(output):
+    try:
+        with open(checkpoint_path(output)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_checkpoint(output, checkpoint):
+    path = checkpoint_path(output)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def _load_library_map(beatmap_md5, mod_sets):
+    """
+    Returns (md5, [(mods, beatmap id, name, note features)] for each mod set),
+    with no maps if the map isn't standard mode, is empty or can't be parsed
+    """
+    try:
+        with metrics.timer("load_map"):
+            if game_mode(beatmap.beatmap_path(beatmap_md5)) != 0:
+                metrics.inc("maps_skipped")
+                return beatmap_md5, []
+            maps = []
+            for mods in mod_sets:
+                map_data = beatmap.load_beatmap(beatmap_md5, **{m: True for m in mods})
+                if len(map_data.hit_objects) == 0:
+                    metrics.inc("maps_skipped")
+                    return beatmap_md5, []
+                maps.append((mods, map_data.beatmap_id, map_data.beatmap_name, note_features(map_data)))
+    except (KeyError, FileNotFoundError):
+        metrics.inc("maps_not_found")
+        return beatmap_md5, []
+    except Exception:
+        logging.exception("error loading beatmap %s", beatmap_md5)
+        metrics.inc("map_errors")
+        return beatmap_md5, []
+    return beatmap_md5, maps
+
+
+def rank_library(output, mod_sets, model_path="model.keras", workers=1, maps_per_batch=256, restart=False):
+    """
+    Write the required skill of every map in the library with each of
+    mod_sets, a list of lists of mod names, to output as csv.
+
+    If output has a checkpoint from an interrupted run with the same model and
+    mods, the run resumes after the last map written, unless restart is set.
+    """
+    model = load_model(model_path)
+    mod_sets = [list(mods) for mods in mod_sets]
+    checkpoint = {"model": model_hash(model), "mods": mod_sets, "last_md5": "", "offset": 0, "maps": 0}
+
+    previous = None if restart or not os.path.exists(output) else read_checkpoint(output)
+    if previous is not None:
+        if (previous["model"], previous["mods"]) != (checkpoint["model"], checkpoint["mods"]):
+            raise CheckpointMismatch(
+                f"{output} was started with a different model or mods. "
+                "Run with the same ones to resume it, or start again with --restart")
+        checkpoint = previous
+        print(f"Resuming after {checkpoint['maps']} maps")
+
+    # sorted, so that maps after the last one written are the ones left to do
+    md5s = sorted(md5 for md5 in beatmap.get_library().md5s if md5 > checkpoint["last_md5"])
+    total = checkpoint["maps"] + len(md5s)
+    load_map = partial(_load_library_map, mod_sets=mod_sets)
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers)
+        maps = metrics.merged(ordered_map(executor, partial(metrics.collecting, load_map), md5s, max_pending=2*maps_per_batch))
+    else:
+        executor = None
+        maps = map(load_map, md5s)
+
+    with open(output, "r+b" if previous is not None else "wb") as f:
+        f.truncate(checkpoint["offset"])
+        f.seek(checkpoint["offset"])
+        if checkpoint["offset"] == 0:
+            f.write((";".join(COLUMNS) + "\n").encode("utf-8"))
+        try:
+            for chunk in chunks(maps, maps_per_batch):
+                variants = [(beatmap_md5, *variant) for beatmap_md5, map_variants in chunk for variant in map_variants]
+                if variants:
+                    with metrics.timer("evaluate_maps"):
+                        all_note_difficulties = evaluate_maps(model, [notes for *_, notes in variants])
+                    with metrics.timer("required_skills"):
+                        skills = get_map_required_skills(all_note_difficulties)
+                    metrics.inc("maps_evaluated", len(variants))
+                    rows = []
+                    for (beatmap_md5, mods, beatmap_id, name, _), note_difficulties, skill in zip(variants, all_note_difficulties, skills):
+                        row = (beatmap_md5, beatmap_id, name.replace(";", ","), " ".join(mods), skill, np.max(note_difficulties))
+                        rows.append(";".join(map(str, row)) + "\n")
+                    f.write("".join(rows).encode("utf-8"))
+
+                # the checkpoint must never point past what's on disk
+                f.flush()
+                os.fsync(f.fileno())
+                checkpoint["last_md5"] = chunk[-1][0]
+                checkpoint["offset"] = f.tell()
+                checkpoint["maps"] += len(chunk)
+                write_checkpoint(output, checkpoint)
+                print(f"\rRanked {checkpoint['maps']}/{total} maps", end="")
+        finally:
+            print()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    os.remove(checkpoint_path(output))
@@ -1,18 +1,38 @@
 import os
 import logging
+import math
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import groupby
 
 import numpy as np
 import numba
+import peewee as pw
+from slider.mod import od_to_ms
 
-from osu_ml_difficulty import db, beatmap
+from osu_ml_difficulty import config, db, beatmap, feature_store, frame_store, metrics
 from osu_ml_difficulty import frame
+from osu_ml_difficulty.util import ordered_map
 
+# increment when the extracted features change, to invalidate data derived from them
+FEATURE_VERSION = 1
+# features extracted from frames packed by frame_store, whose positions are
+# quantized, so differ slightly from features extracted from the saved frames
+PACKED_FEATURE_VERSION = FEATURE_VERSION * 1000 + frame_store.FRAME_FORMAT_VERSION
+# recorded for replays whose frames changed since their features were extracted
+OUTDATED_VERSION = 0
 
 @numba.njit(cache=True)
-def hit_object_clicks(clicks, hit_objects):
+def _match_clicks(clicks, hit_objects, hit_window, result):
+    """
+    Writes the nearest click to each hit object into result, ignoring clicks
+    further than hit_window from their nearest hit object
+    """
     n_hit_objects = hit_objects.shape[0]
-    result = np.full((hit_objects.shape[0], clicks.shape[1]), np.nan, dtype="f")
     TIME = frame.TIME
+    if n_hit_objects == 0:
+        return
 
     j=0
     for click in clicks:
@@ -24,34 +44,109 @@ def hit_object_clicks(clicks, hit_objects):
             j += 1
 
         hit_object_time = hit_objects[j, TIME]
+        if abs(hit_object_time-t) > hit_window:
+            continue
         nearest_time = abs(result[j, TIME] - t)
         if np.isnan(nearest_time) or nearest_time > abs(hit_object_time-t):
             result[j] = click
 
+@numba.njit(cache=True)
+def hit_object_clicks(clicks, hit_objects, hit_window=np.inf):
+    result = np.full((hit_objects.shape[0], clicks.shape[1]), np.nan, dtype="f")
+    _match_clicks(clicks, hit_objects, hit_window, result)
     return result
 
+@numba.njit(cache=True, parallel=True)
+def hit_object_clicks_batch(clicks, click_offsets, hit_objects, hit_object_offsets, hit_windows):
+    """
+    hit_object_clicks for many replays in parallel. Replay i's clicks are
+    clicks[click_offsets[i]:click_offsets[i+1]], and its hit objects and
+    result rows are hit_object_offsets[i]:hit_object_offsets[i+1]
+    """
+    result = np.full((hit_objects.shape[0], clicks.shape[1]), np.nan, dtype=np.float32)
+    for i in numba.prange(click_offsets.shape[0] - 1):
+        _match_clicks(
+            clicks[click_offsets[i]:click_offsets[i+1]],
+            hit_objects[hit_object_offsets[i]:hit_object_offsets[i+1]],
+            hit_windows[i],
+            result[hit_object_offsets[i]:hit_object_offsets[i+1]]
+        )
+    return result
 
 
-def replay_features(replay: db.Replay, map_data: beatmap.MapData):
+def hit_window(map_data: beatmap.MapData):
     """
-    Returns hit error and velocity for nearest click to each hit object
+    Milliseconds either side of a hit object in which a click can hit it, in
+    the same time scale as map_data's hit objects
     """
-    if map_data is None:
-        return None
+    window = od_to_ms(map_data.od).hit_50
+    if map_data.dt:
+        return window * 2/3
+    if map_data.ht:
+        return window * 4/3
+    return window
+
 
-    clicks = replay.load_frames()
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
 
+def click_features_batch(replay_clicks, map_datas, dts, hts, match_hit_window=config.MATCH_HIT_WINDOW):
+    """
+    click_features for many replays, matching clicks for all of them in a
+    single parallel call. Takes lists of each replay's (n, frame.N_COLUMNS)
+    click frames, MapData and dt/ht mods.
+
+    Returns a list with features for each replay, or None for replays without clicks
+    """
+    if not replay_clicks:
+        return []
+    click_counts = [len(clicks) for clicks in replay_clicks]
+    hit_object_counts = [len(map_data.hit_objects) for map_data in map_datas]
+    click_offsets = _offsets(click_counts)
+    hit_object_offsets = _offsets(hit_object_counts)
+
+    clicks = np.concatenate(replay_clicks)
+    # float32, so times are rounded the same way as scaling each replay's clicks
+    time_scales = np.where(dts, 2/3, np.where(hts, 4/3, 1)).astype(clicks.dtype)
+    clicks[:, frame.TIME] *= np.repeat(time_scales, click_counts)
+
+    hit_objects = np.concatenate([map_data.hit_objects for map_data in map_datas])
+    if match_hit_window:
+        hit_windows = np.array([hit_window(map_data) for map_data in map_datas])
+    else:
+        hit_windows = np.full(len(map_datas), np.inf)
+    nearest_hit_object_click = hit_object_clicks_batch(
+        clicks, click_offsets, hit_objects, hit_object_offsets, hit_windows)
+
+    error = nearest_hit_object_click[:,0:3] - hit_objects
+    scales = np.array([map_data.scale for map_data in map_datas], dtype=error.dtype)
+    error[:,frame.POS] *= np.repeat(scales, hit_object_counts)[:, np.newaxis]
+    features = np.column_stack((error, nearest_hit_object_click[:,frame.V]))
+
+    return [
+        features[hit_object_offsets[i]:hit_object_offsets[i+1]] if click_counts[i] else None
+        for i in range(len(replay_clicks))
+    ]
+
+
+def click_features(clicks, map_data: beatmap.MapData, dt=False, ht=False, match_hit_window=config.MATCH_HIT_WINDOW):
+    """
+    Returns hit error and velocity for nearest click to each hit object
+    """
     if clicks.size == 0:
         return None
 
-    if replay.dt:
+    if dt:
         clicks[:,frame.TIME] *= 2/3
-    elif replay.ht:
+    elif ht:
         clicks[:,frame.TIME] *= 4/3
 
     scale = map_data.scale
     hit_objects = map_data.hit_objects
-    nearest_hit_object_click = hit_object_clicks(clicks, hit_objects)
+    window = hit_window(map_data) if match_hit_window else np.inf
+    nearest_hit_object_click = hit_object_clicks(clicks, hit_objects, window)
 
     error = nearest_hit_object_click[:,0:3] - hit_objects
     error[:,frame.POS] *= scale
@@ -59,60 +154,320 @@ def replay_features(replay: db.Replay, map_data: beatmap.MapData):
     return np.column_stack((error, nearest_hit_object_click[:,frame.V]))
 
 
-def calculate_replay_features(replay: db.Replay):
-    bmap = beatmap.beatmap_from_replay(replay)
-    features = replay_features(replay, bmap)
-    if features is not None:
+def replay_features(replay: db.Replay, map_data: beatmap.MapData):
+    """
+    Returns hit error and velocity for nearest click to each hit object
+    """
+    if map_data is None:
+        return None
+
+    return click_features(replay.load_frames(), map_data, dt=replay.dt, ht=replay.ht)
+
+
+def save_features(path, features):
+    """
+    Save features via a temporary file, so an interrupted run never leaves a
+    truncated feature file behind
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as feature_file:
+            np.save(feature_file, features)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FeatureProgress:
+    """
+    Aggregates progress and error counts from feature extraction workers
+    """
+    def __init__(self, total, progress=0):
+        self.total = total
+        self.progress = progress
+        self.processed = 0
+        self.skipped = 0
+        self.errored = 0
+
+    def update(self, progress, processed, skipped, errors, worker_metrics=None):
+        self.progress += progress
+        self.processed += processed
+        self.skipped += skipped
+        self.errored += len(errors)
+        metrics.merge(worker_metrics)
+        metrics.inc("replays_processed", processed)
+        metrics.inc("replays_skipped", skipped)
+        metrics.inc("replays_failed", len(errors))
+        for filename, beatmap_md5, error in errors:
+            logging.error("Failed to parse replay: %s map: %s\n%s", filename, beatmap_md5, error)
+        self.print()
+
+    def print(self):
+        print(
+            f"\r"
+            f"processed {self.processed} replays. "
+            f"Progress: {self.progress}/{self.total}. "
+            f"Couldn't find {self.skipped} beatmaps, and failed to process {self.errored}",
+            end=""
+        )
+
+
+def feature_version(replay: db.Replay):
+    """
+    Version of the features extracted from a replay's frames as they're loaded now
+    """
+    return PACKED_FEATURE_VERSION if replay.has_packed_frames() else FEATURE_VERSION
+
+
+def load_replay_inputs(replay: db.Replay):
+    """
+    Returns (clicks, map_data) for a replay, raising KeyError if its beatmap
+    can't be found
+    """
+    with metrics.timer("load_beatmap"):
+        map_data = beatmap.beatmap_from_replay(replay)
+    with metrics.timer("load_frames"):
+        clicks = replay.load_frames()
+    if clicks.size == 0:
+        clicks = clicks.reshape(0, frame.N_COLUMNS)
+    if clicks.ndim != 2 or clicks.shape[1] != frame.N_COLUMNS:
+        raise ValueError(f"expected {frame.N_COLUMNS} columns of click frames, got shape {clicks.shape}")
+    return clicks, map_data
+
+
+def calculate_replay_chunk(replays, skip_exceptions=True):
+    """
+    Calculate features for a list of replays. Clicks for the whole chunk are
+    matched to hit objects in a single parallel call.
+
+    Returns (progress, processed, skipped, errors, statuses, worker metrics) so
+    that results from worker processes can be combined by a FeatureProgress,
+    with a (replay id, feature version, status, error class) for each replay to
+    save with save_feature_statuses
+    """
+    status = db.FeatureStatus
+    skipped = 0
+    errors = []
+    statuses = []
+    loaded = []
+    versions = {}
+    for replay in replays:
+        versions[replay.id] = feature_version(replay)
         try:
-            np.save(replay.feature_path(), features)
-        except:
-            os.remove(replay.feature_path())
-            raise
-    return features
+            loaded.append((replay, *load_replay_inputs(replay)))
+        except KeyError: # beatmap not found
+            skipped += 1
+            statuses.append((replay.id, versions[replay.id], status.MISSING_BEATMAP, None))
+        except Exception as e:
+            if not skip_exceptions:
+                raise
+            errors.append((replay.filename, replay.beatmap_md5, traceback.format_exc()))
+            statuses.append((replay.id, versions[replay.id], status.ERROR, type(e).__name__))
+
+    with metrics.timer("match_clicks"):
+        all_features = click_features_batch(
+            [clicks for _, clicks, _ in loaded],
+            [map_data for _, _, map_data in loaded],
+            [replay.dt for replay, _, _ in loaded],
+            [replay.ht for replay, _, _ in loaded],
+        )
+
+    processed = 0
+    for (replay, _, _), features in zip(loaded, all_features):
+        if features is None:
+            statuses.append((replay.id, versions[replay.id], status.NO_CLICKS, None))
+            continue
+        try:
+            with metrics.timer("save_features"):
+                save_features(replay.feature_path(), features)
+            processed += 1
+            statuses.append((replay.id, versions[replay.id], status.OK, None))
+        except Exception as e:
+            if not skip_exceptions:
+                raise
+            errors.append((replay.filename, replay.beatmap_md5, traceback.format_exc()))
+            statuses.append((replay.id, versions[replay.id], status.ERROR, type(e).__name__))
+    return len(replays), processed, skipped, errors, statuses, metrics.drain()
+
+
+def save_feature_statuses(rows):
+    """
+    Record (replay id, feature version, status, error class) results of feature
+    extraction
+    """
+    fields = [db.FeatureStatus.replay, db.FeatureStatus.version, db.FeatureStatus.status, db.FeatureStatus.error]
+    with db.db:
+        # sqlite limits the number of variables in a statement
+        for i in range(0, len(rows), 200):
+            db.FeatureStatus.insert_many(rows[i:i+200], fields=fields).on_conflict_replace().execute()
+
+
+def pending_replays(force=False, force_version=None, retry_failed=False):
+    """
+    Query for replays which need their features extracted, sorted by beatmap:
+    replays never extracted, extracted by an outdated version, from frames
+    which have since been packed, or by force_version, and if retry_failed,
+    replays whose beatmap was missing or which raised an error. Every replay
+    if force is set.
+    """
+    status = db.FeatureStatus
+    query = db.Replay.select().order_by(db.Replay.beatmap_md5)
+    if force:
+        return query
+    pending = status.replay.is_null() | status.version.not_in([FEATURE_VERSION, PACKED_FEATURE_VERSION])
+    if force_version is not None:
+        pending |= status.version == force_version
+    if retry_failed:
+        pending |= status.status.in_(status.FAILED)
+    return query.join(status, pw.JOIN.LEFT_OUTER).where(pending)
+
+
+def pack_user_frames(user, remove_files=False, velocities=True):
+    """
+    Pack a user's click frames with frame_store.pack_user_frames, recording the
+    features of replays whose frames changed as OUTDATED_VERSION, so that
+    pending_replays re-extracts them. Returns the number of replays packed.
+    """
+    old_store = frame_store.get_store(user.id)
+    count = frame_store.pack_user_frames(user, remove_files=remove_files, velocities=velocities)
+    store = frame_store.get_store(user.id)
+    # repacking the same frames gives the same rows, unless velocities were
+    # added or dropped
+    changed = [
+        replay_id for replay_id in store.offsets
+        if old_store is None or replay_id not in old_store or old_store.velocities != store.velocities
+    ]
+    status = db.FeatureStatus
+    with db.db:
+        # sqlite limits the number of variables in a statement
+        for i in range(0, len(changed), 200):
+            (status
+                .update(version=OUTDATED_VERSION)
+                .where(status.replay.in_(changed[i:i+200]) & status.status.not_in(status.FAILED))
+                .execute())
+    return count
+
+
+def record_existing_features():
+    """
+    Record replays without a status which already have features as extracted by
+    the current FEATURE_VERSION from the saved frames, e.g. from
+    import_replay_data.py --extract-features or databases from before statuses
+    were recorded
+    """
+    status = db.FeatureStatus
+    with db.db:
+        unrecorded = list(
+            db.Replay.select().join(status, pw.JOIN.LEFT_OUTER).where(status.replay.is_null()))
+    save_feature_statuses([
+        (replay.id, FEATURE_VERSION, status.OK, None) for replay in unrecorded if replay.has_features()
+    ])
+
+
+def replay_chunks(replays, chunk_size):
+    """
+    Split replays (sorted by beatmap) into chunks of at most chunk_size,
+    keeping replays of the same beatmap together where they fit in a chunk so
+    that each worker can reuse its beatmap cache. Beatmaps with more replays
+    than that are split over several chunks, so they don't hold up one worker.
+    """
+    chunk = []
+    for _, beatmap_replays in groupby(replays, key=lambda r: r.beatmap_md5):
+        beatmap_replays = list(beatmap_replays)
+        if chunk and len(chunk) + len(beatmap_replays) > chunk_size:
+            yield chunk
+            chunk = []
+        while len(beatmap_replays) > chunk_size:
+            yield beatmap_replays[:chunk_size]
+            beatmap_replays = beatmap_replays[chunk_size:]
+        chunk.extend(beatmap_replays)
+    if chunk:
+        yield chunk
 
 
-def calculate_all_replay_features(force=False, skip_exceptions=True):
+def calculate_all_replay_features(force=False, skip_exceptions=True, workers=1, chunk_size=500,
+                                  force_version=None, retry_failed=False):
+    """
+    Extract features for replays in the db which don't have them, using the
+    status recorded for each replay, so an interrupted run can be resumed by
+    running it again.
+
+    force recalculates every replay, force_version recalculates replays
+    extracted by that FEATURE_VERSION or PACKED_FEATURE_VERSION, and retry_failed retries replays whose
+    beatmap was missing or which raised an error.
+    """
+    # databases created before statuses were recorded
+    db.db.create_tables([db.FeatureStatus])
+    if force:
+        # packed features would shadow the recalculated ones
+        feature_store.remove_stores()
+    else:
+        record_existing_features()
+
     with db.db:
-        processed = 0
-        progress = 0
-        skipped = 0
-        errored = 0
         total = db.Replay.select().count()
-        print()
-        for replay in db.Replay.select():
-            progress += 1
-            if force or not os.path.exists(replay.feature_path()):
-                try:
-                    if calculate_replay_features(replay) is not None:
-                        processed += 1
-                        if processed % 100 == 0:
-                            print(
-                                f"\r"
-                                f"processed {processed} replays. "
-                                f"Progress: {progress}/{total}. "
-                                f"Couldn't find {skipped} beatmaps, and failed to process {errored}",
-                                end=""
-                            )
-
-                except KeyError: # beatmap not found
-                    skipped += 1
-                except Exception:
-                    if not skip_exceptions:
-                        raise
-                    errored += 1
-                    logging.exception(
-                        "Failed to parse replay: %s map: %s", 
-                        replay,
-                        replay.beatmap_md5
-                    )
-
-                    print(
-                        f"\r"
-                        f"processed {processed} replays. "
-                        f"Progress: {progress}/{total}. "
-                        f"Couldn't find {skipped} beatmaps, and failed to process {errored}",
-                        end=""
-                    )
+        pending = list(pending_replays(force, force_version, retry_failed))
+    if not force:
+        pending = _unpack_stale_features(pending)
+
+    progress = FeatureProgress(total, total - len(pending))
+    print()
+    progress.print()
+
+    def update(result):
+        *counts, statuses, worker_metrics = result
+        save_feature_statuses(statuses)
+        progress.update(*counts, worker_metrics)
+
+    calculate_chunk = partial(calculate_replay_chunk, skip_exceptions=skip_exceptions)
+    if workers > 1:
+        # smaller chunks for few replays, so every worker gets some
+        chunk_size = max(1, min(chunk_size, math.ceil(len(pending) / (4 * workers))))
+    chunks = replay_chunks(pending, chunk_size)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            for result in ordered_map(executor, calculate_chunk, chunks, max_pending=2*workers):
+                update(result)
+    else:
+        for chunk in chunks:
+            update(calculate_chunk(chunk))
+    print()
+
+
+def _unpack_stale_features(pending):
+    """
+    Packed features would shadow recalculated ones, so remove the stores of
+    users with pending replays in them, adding their replays which were only in
+    the store to pending. Returns the new pending list, sorted by beatmap.
+    """
+    stale_users = {
+        replay.user_id for replay in pending
+        if (store := feature_store.get_store(replay.user_id)) is not None and replay.id in store
+    }
+    if not stale_users:
+        return pending
+
+    pending_ids = {replay.id for replay in pending}
+    with db.db:
+        unpacked = [
+            replay for replay in db.Replay.select().where(db.Replay.user.in_(list(stale_users)))
+            if replay.id not in pending_ids and not os.path.exists(replay.feature_path())
+        ]
+    for user_id in stale_users:
+        feature_store.remove_user_store(user_id)
+    return sorted(pending + unpacked, key=lambda replay: replay.beatmap_md5)
+
+
+def pack_all_replay_features(remove_files=False):
+    """
+    Pack each user's replay features into a single memory mappable store
+    """
+    with db.db:
+        for user in db.User.select():
+            count = feature_store.pack_user_features(user, remove_files=remove_files)
+            print(f"Packed features for {user.username}: {count} replays")
 
 if __name__ == "__main__":
     calculate_all_replay_features()
@@ -0,0 +1,100 @@
+"""
+Writers for map-list results.
+
+CsvWriter prints the summary of each map as text, as map-list always has.
+ArrowWriter also keeps each map's note difficulties, writing them as a list
+column to a Parquet or Arrow IPC file, one batch of rows at a time, so the
+results can be read back or memory mapped without scoring the maps again.
+"""
+
+import sys
+
+import numpy as np
+
+
+class CsvWriter:
+    """
+    Writes semicolon separated summaries, without note difficulties
+    """
+    def __init__(self, path=None):
+        self.file = sys.stdout if path is None else open(path, "w", encoding="utf-8")
+        print("id", "name", "mods", "difficulty", "peak_difficulty", "ppv2_aim", sep=";", file=self.file)
+
+    def write(self, rows):
+        """
+        Write rows of (beatmap id, name, mods, required skill, note difficulties, ppv2_aim)
+        """
+        for beatmap_id, name, mods_string, skill, note_difficulties, ppv2_aim in rows:
+            print(beatmap_id, name.replace(";", ","), mods_string, skill, np.max(note_difficulties), ppv2_aim, sep=";", file=self.file)
+
+    def close(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Writing parquet or arrow files requires pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+class ArrowWriter:
+    """
+    Writes rows with their note difficulties to a Parquet file, or an Arrow IPC
+    file if path doesn't end in .parquet. Each write() is one record batch, or
+    one row group for Parquet.
+    """
+    def __init__(self, path):
+        self.pa = pa = _import_pyarrow()
+        self.schema = pa.schema([
+            ("id", pa.int64()),
+            ("name", pa.string()),
+            ("mods", pa.string()),
+            ("difficulty", pa.float64()),
+            ("peak_difficulty", pa.float32()),
+            ("ppv2_aim", pa.float64()),
+            ("note_difficulties", pa.list_(pa.float32())),
+        ])
+        if path.endswith(".parquet"):
+            self.writer = pa.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        pa = self.pa
+        beatmap_ids, names, mods, skills, all_note_difficulties, ppv2_aims = zip(*rows)
+        all_note_difficulties = [np.ravel(d).astype("float32") for d in all_note_difficulties]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int32)
+        np.cumsum([len(d) for d in all_note_difficulties], out=offsets[1:])
+        batch = pa.record_batch([
+            pa.array(beatmap_ids, pa.int64()),
+            pa.array(names, pa.string()),
+            pa.array(mods, pa.string()),
+            pa.array(skills, pa.float64()),
+            pa.array([d.max() if len(d) else np.nan for d in all_note_difficulties], pa.float32()),
+            pa.array(ppv2_aims, pa.float64()),
+            pa.ListArray.from_arrays(pa.array(offsets), pa.array(np.concatenate(all_note_difficulties))),
+        ], schema=self.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(output=None):
+    """
+    CsvWriter to stdout if output is None, or to output if it ends in .csv,
+    otherwise an ArrowWriter
+    """
+    if output is None:
+        return CsvWriter()
+    if output.endswith(".csv"):
+        return CsvWriter(output)
+    return ArrowWriter(output)
@@ -0,0 +1,240 @@
+"""
+Local HTTP server evaluating the difficulty of maps, keeping the model and
+beatmap caches loaded between requests.
+
+    GET /difficulty?id=<beatmap id>&mods=hd+dt
+    GET /difficulty?md5=<beatmap md5>&mods=hr
+    POST /difficulty with a JSON list of {"id" or "md5", "mods"} objects
+
+Responds with a JSON object (or list for POST) of the map's required skill,
+peak difficulty and the difficulty of each note. Maps requested at about the
+same time, by any number of clients, are evaluated together in a single model
+call.
+"""
+
+import json
+import logging
+import queue
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from . import beatmap, metrics
+from .dataset import AugmentedBeatmapColumns, note_features
+from .map_difficulty import evaluate_maps, get_map_required_skills
+from .numpy_model import load_model
+from .util import MODS, parse_mods
+
+class MicroBatcher(threading.Thread):
+    """
+    Evaluates maps submitted from many threads, collecting maps submitted within
+    max_delay seconds of each other into batches of up to max_maps
+    """
+    def __init__(self, model, max_maps=256, max_delay=0.005):
+        super().__init__(daemon=True, name="micro-batcher")
+        self.model = model
+        self.max_maps = max_maps
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+
+    def submit(self, notes):
+        """
+        Returns a Future of (note difficulties, required skill) for a map's
+        note features
+        """
+        future = Future()
+        self.queue.put((notes, future))
+        return future
+
+    def stop(self):
+        """
+        Evaluate the maps already submitted, then stop
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_maps:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                self.evaluate(batch)
+
+    def evaluate(self, batch):
+        try:
+            with metrics.timer("evaluate_maps"):
+                all_note_difficulties = evaluate_maps(self.model, [notes for notes, _ in batch])
+            with metrics.timer("required_skills"):
+                skills = get_map_required_skills(all_note_difficulties)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        metrics.inc("model_calls")
+        metrics.inc("maps_evaluated", len(batch))
+        for (_, future), note_difficulties, skill in zip(batch, all_note_difficulties, skills):
+            future.set_result((note_difficulties, skill))
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def load_map(request):
+    """
+    Returns (md5, mods, MapData) for a request with an id or md5 and mods,
+    raising KeyError if the map can't be found
+    """
+    mods = request.get("mods", "")
+    if not isinstance(mods, str) and not (isinstance(mods, list) and all(isinstance(m, str) for m in mods)):
+        raise BadRequest(f"invalid mods: {mods!r}, expected a string or list of strings")
+    try:
+        mods = parse_mods(mods)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    if request.get("md5"):
+        md5 = str(request["md5"])
+    elif request.get("id") is not None:
+        try:
+            beatmap_id = int(request["id"])
+        except (TypeError, ValueError):
+            raise BadRequest(f"invalid beatmap id: {request['id']}")
+        md5 = beatmap.beatmap_md5_from_id(beatmap_id)
+    else:
+        raise BadRequest("expected a beatmap id or md5")
+    with metrics.timer("load_map"):
+        map_data = beatmap.get_beatmap(md5, **{m: m in mods for m in MODS})
+    return md5, mods, map_data
+
+
+class DifficultyHandler(BaseHTTPRequestHandler):
+    server_version = "osu-ml-difficulty"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/difficulty":
+            return self.send_json(404, {"error": "not found"})
+        request = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.respond([request], single=True)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/difficulty":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            requests = json.loads(body)
+        except ValueError:
+            return self.send_json(400, {"error": "expected a JSON request body"})
+        single = isinstance(requests, dict)
+        if single:
+            requests = [requests]
+        if not isinstance(requests, list) or not all(isinstance(r, dict) for r in requests):
+            return self.send_json(400, {"error": "expected a JSON object or list of objects"})
+        self.respond(requests, single)
+
+    def respond(self, requests, single):
+        # load every map, then submit them all before waiting, so they can
+        # share a model call
+        loads = [(request, self.server.loader.submit(load_map, request)) for request in requests]
+        loaded = []
+        for request, load in loads:
+            try:
+                loaded.append((request, *load.result()))
+            except BadRequest as e:
+                return self.send_json(400, {"error": str(e)})
+            except KeyError:
+                metrics.inc("maps_not_found")
+                loaded.append((request, None, None, None))
+            except Exception as e:
+                logging.exception("error loading map for %s", request)
+                metrics.inc("map_errors")
+                return self.send_json(500, {"error": f"failed to load map: {e}", "request": request})
+        pending = [
+            (request, md5, mods, map_data,
+             None if map_data is None else self.server.batcher.submit(note_features(map_data)))
+            for request, md5, mods, map_data in loaded
+        ]
+
+        results = []
+        for request, md5, mods, map_data, future in pending:
+            if future is None:
+                results.append({"error": "beatmap not found", "request": request})
+                continue
+            try:
+                note_difficulties, skill = future.result()
+            except Exception as e:
+                logging.exception("error evaluating map %s", md5)
+                metrics.inc("evaluation_errors")
+                return self.send_json(500, {"error": f"failed to evaluate map: {e}", "request": request})
+            note_difficulties = np.ravel(note_difficulties)
+            results.append({
+                "beatmap_id": map_data.beatmap_id,
+                "beatmap_md5": md5,
+                "name": map_data.beatmap_name,
+                "mods": mods,
+                "required_skill": None if np.isnan(skill) else float(skill),
+                "peak_difficulty": float(np.max(note_difficulties)) if len(note_difficulties) else None,
+                "note_difficulties": note_difficulties.tolist(),
+            })
+
+        if single:
+            self.send_json(404 if "error" in results[0] else 200, results[0])
+        else:
+            self.send_json(200, results)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class DifficultyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, model, max_maps=256, max_delay=0.005):
+        super().__init__(address, DifficultyHandler)
+        self.batcher = MicroBatcher(model, max_maps, max_delay)
+        self.batcher.start()
+        # each request has its own thread, but slider's library is per thread,
+        # so maps are loaded on one thread to share a library and its cache
+        self.loader = ThreadPoolExecutor(1, thread_name_prefix="map-loader")
+
+
+def serve(model_path="model.keras", host="127.0.0.1", port=8000, max_maps=256, max_delay=0.005):
+    model = load_model(model_path)
+    # compile before the first request. numba's thread pool is also started
+    # here, as the process hangs on exit if it's first used by another thread
+    get_map_required_skills(evaluate_maps(model, [np.zeros((1, AugmentedBeatmapColumns.N_COLUMNS), dtype="float32")]))
+    server = DifficultyServer((host, port), model, max_maps, max_delay)
+    # exit cleanly when stopped by a service manager, printing metrics
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving map difficulty on http://{host}:{server.server_address[1]}/difficulty")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.loader.shutdown()
+        server.batcher.stop()
@@ -0,0 +1,50 @@
+"""
+Helpers shared by the commands which load and evaluate maps.
+"""
+
+from collections import deque
+
+
+MODS = ("dt", "hd", "hr", "ez", "ht")
+
+
+def parse_mods(mods):
+    """
+    Mods as a list of names from e.g. "hd dt", "hd+dt", "HD,DT" or ["hd", "dt"],
+    raising ValueError for unknown mods
+    """
+    if isinstance(mods, str):
+        mods = mods.replace("+", " ").replace(",", " ").split()
+    mods = [m.lower() for m in mods]
+    unknown = [m for m in mods if m not in MODS]
+    if unknown:
+        raise ValueError(f"unknown mods: {' '.join(unknown)}, expected some of {' '.join(MODS)}")
+    return [m for m in MODS if m in mods]
+
+
+def ordered_map(executor, func, iterable, max_pending):
+    """
+    Like executor.map, but only keeps max_pending tasks in flight so that results
+    don't pile up in memory when they're consumed more slowly than produced
+    """
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def chunks(iterable, chunk_size):
+    """
+    Lists of up to chunk_size consecutive items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk